@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""
+Microbenchmarks for Blinq hot paths
+
+Run this from the top of the source tree:
+
+  python bench/bench.py                       run all benchmarks
+  python bench/bench.py escape sort           run benchmarks matching names
+  python bench/bench.py --save base.json      save results as a baseline
+  python bench/bench.py --compare base.json   fail if anything regressed
+
+Each benchmark reports operations per second and the number of objects
+allocated per operation.  Python 2 has no allocation tracer, so objects
+are counted by holding on to the results of a number of operations and
+counting the new objects tracked by the garbage collector.  This counts
+the containers, instances, and other tracked objects that make up each
+result, but not strings or numbers, or temporaries freed during the
+operation.  With --compare, the exit status is 1 if any benchmark is
+slower than its baseline, or allocates more objects per operation than
+its baseline, by more than --threshold, given as a fraction.
+"""
+
+import gc
+import json
+import optparse
+import os
+import os.path
+import random
+import sys
+import time
+from StringIO import StringIO
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import blinq.config
+import blinq.ext
+import blinq.reqs
+import blinq.reqs.cmd
+import blinq.reqs.web
+import blinq.utils
+
+
+benchmarks = []
+
+def benchmark (func):
+    """
+    Decorator to register a benchmark, which returns the function to time
+
+    The function to time should return the result of its operation, so
+    the objects allocated for the result can be counted.
+    """
+    benchmarks.append (func)
+    return func
+
+
+QUERY = '&'.join (['key%i=value%%20%i' % (i, i) for i in range (20)])
+COOKIES = '; '.join (['cookie%i=%s' % (i, 'x' * 20) for i in range (10)])
+
+def make_environ (**kw):
+    environ = {'REQUEST_METHOD': 'GET',
+               'PATH_INFO': '/project/module/branch/page',
+               'QUERY_STRING': QUERY,
+               'HTTP_COOKIE': COOKIES}
+    environ.update (kw)
+    return environ
+
+@benchmark
+def webrequest_init ():
+    environ = make_environ ()
+    def run ():
+        req = blinq.reqs.web.WebRequest (environ=environ, stdin=None)
+        req.path
+        req.query
+        req.cookies
+        return req
+    return run
+
+@benchmark
+def webrequest_multipart ():
+    parts = []
+    for i in range (20):
+        parts.append ('--BOUNDARY\r\nContent-Disposition: form-data; name="field%i"'
+                      '\r\n\r\n%s\r\n' % (i, 'v' * 200))
+    parts.append ('--BOUNDARY\r\nContent-Disposition: form-data; name="upload";'
+                  ' filename="data.txt"\r\nContent-Type: text/plain\r\n\r\n%s\r\n'
+                  % ('d' * 100000))
+    parts.append ('--BOUNDARY--\r\n')
+    body = ''.join (parts)
+    environ = make_environ (REQUEST_METHOD='POST',
+                            CONTENT_TYPE='multipart/form-data; boundary=BOUNDARY',
+                            CONTENT_LENGTH=str (len(body)))
+    def run ():
+        req = blinq.reqs.web.WebRequest (environ=environ, stdin=StringIO (body))
+        req.post_data.close ()
+        return req
+    return run
+
+class Item (object):
+    def __init__ (self, name, score, owner):
+        self.name = name
+        self.score = score
+        self.owner = owner
+
+def make_items ():
+    rand = random.Random (42)
+    owners = [Item ('owner%i' % i, i, None) for i in range (50)]
+    items = []
+    for i in range (10000):
+        name = None
+        if rand.random () > 0.1:
+            name = rand.choice (['Alpha', 'beta', u'Gamma']) + str (rand.randint (0, 999))
+        items.append (Item (name, rand.randint (0, 100), rand.choice (owners)))
+    return items
+
+@benchmark
+def attrsorted_10k ():
+    items = make_items ()
+    def run ():
+        return blinq.utils.attrsorted (items, '-score', 'name', ('owner', 'name'))
+    return run
+
+@benchmark
+def attrsorted_topk_10k ():
+    items = make_items ()
+    def run ():
+        return blinq.utils.attrsorted_topk (items, 50, '-score', 'name')
+    return run
+
+@benchmark
+def html_escape ():
+    data = {'title': u'Caf\xe9 <Menu> & "Specials"',
+            'items': tuple ([u'<li>Item %i & more</li>' % i for i in range (50)]),
+            'plain': 'nothing to escape here',
+            'nested': {'a': '<b>', 'b': ('<i>', u'\xe9')}}
+    escape = blinq.reqs.web.HtmlPayload.escape
+    def run ():
+        esc = escape (data)
+        esc['title']
+        esc['items']
+        esc['plain']
+        esc['nested']['b']
+        return esc
+    return run
+
+@benchmark
+def config_getattr ():
+    def run ():
+        return (blinq.config.web_root_url,
+                blinq.config.mail_port,
+                blinq.config.mail_server)
+    return run
+
+class BenchPoint (blinq.ext.ExtensionPoint):
+    pass
+
+for i in range (100):
+    type ('BenchExt%i' % i, (BenchPoint,), {})
+
+@benchmark
+def get_extensions ():
+    def run ():
+        return BenchPoint.get_extensions ()
+    return run
+
+class BenchCmd (blinq.reqs.cmd.CmdResponder):
+    @classmethod
+    def respond (cls, request):
+        return blinq.reqs.cmd.CmdResponse (request)
+
+cmds = [type ('BenchCmd%i' % i, (BenchCmd,),
+              {'command': 'cmd%i' % i, 'synopsis': ''})
+        for i in range (100)]
+
+@benchmark
+def cmd_respond ():
+    request = blinq.reqs.cmd.CmdRequest (argv=['cmd50'], environ={})
+    for cmd in cmds:
+        request.add_tool_responder (cmd)
+    def run ():
+        req = request.new_request (['cmd50', 'arg'])
+        req.parse_common_options ()
+        return blinq.reqs.cmd.CmdResponder.respond (req)
+    return run
+
+
+def count_objects (run, count=20):
+    """Get the number of tracked objects allocated for each result of run"""
+    results = [None] * count
+    gc.collect ()
+    gc.disable ()
+    try:
+        before = len (gc.get_objects ())
+        for i in range (count):
+            results[i] = run ()
+        after = len (gc.get_objects ())
+    finally:
+        gc.enable ()
+    return float (after - before) / count
+
+def measure (func, min_time, repeat):
+    """Get the best ops per second and objects per operation for func"""
+    run = func ()
+    run ()
+    best = 0.0
+    for i in range (repeat):
+        count = 0
+        gc.collect ()
+        start = time.time ()
+        elapsed = 0.0
+        while elapsed < min_time:
+            run ()
+            count += 1
+            elapsed = time.time () - start
+        best = max (best, count / elapsed)
+    return {'ops': best, 'objects': count_objects (run)}
+
+def main (argv=None):
+    parser = optparse.OptionParser (usage='%prog [options] [NAME...]')
+    parser.add_option ('--save', dest='save', default=None,
+                       help='save results to a JSON baseline file')
+    parser.add_option ('--compare', dest='compare', default=None,
+                       help='compare results to a JSON baseline file')
+    parser.add_option ('--threshold', dest='threshold', type='float', default=0.2,
+                       help='allowed slowdown as a fraction of the baseline')
+    parser.add_option ('--time', dest='min_time', type='float', default=0.5,
+                       help='minimum seconds to run each benchmark')
+    parser.add_option ('--repeat', dest='repeat', type='int', default=3,
+                       help='number of timing runs to take the best of')
+    (options, args) = parser.parse_args (argv)
+
+    baseline = None
+    if options.compare is not None:
+        fp = open (options.compare)
+        baseline = json.load (fp)
+        fp.close ()
+
+    results = {}
+    regressed = []
+    for func in benchmarks:
+        name = func.__name__
+        if len(args) > 0 and not [arg for arg in args if arg in name]:
+            continue
+        result = measure (func, options.min_time, options.repeat)
+        results[name] = result
+        line = '%-24s %14.1f ops/sec %10.1f objects' % (name, result['ops'], result['objects'])
+        if baseline is not None and name in baseline:
+            change = result['ops'] / baseline[name]['ops'] - 1
+            line += '  %+6.1f%%' % (change * 100)
+            # Allow one object of slack, so tiny counts don't flap
+            limit = baseline[name].get ('objects', 0) * (1 + options.threshold) + 1
+            if change < -options.threshold:
+                line += '  REGRESSED'
+                regressed.append (name)
+            elif result['objects'] > limit:
+                line += '  MORE OBJECTS'
+                regressed.append (name)
+        print line
+
+    if options.save is not None:
+        fp = open (options.save, 'w')
+        json.dump (results, fp, indent=2, sort_keys=True)
+        fp.close ()
+    if len(regressed) > 0:
+        print >>sys.stderr, 'Regressed: ' + ', '.join (regressed)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit (main ())
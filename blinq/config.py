@@ -23,9 +23,17 @@ class Config (object):
         self._options = {}
         self._config = ConfigParser.RawConfigParser()
         self._filename = None
+        self._mtime = None
+        self._cache = {}
 
     def init (self, filename):
+        import os
         self._filename = filename
+        self._cache = {}
+        try:
+            self._mtime = os.stat (self._filename).st_mtime
+        except:
+            self._mtime = None
         try:
             fp = open(self._filename)
             self._config.readfp (fp)
@@ -33,6 +41,27 @@ class Config (object):
         except:
             pass
 
+    def reload (self):
+        """
+        Re-read the config file if it has changed since it was last read
+
+        The file is only parsed again if its modification time differs.
+        Returns True if the file was re-read.
+        """
+        import ConfigParser
+        import os
+        if self._filename is None:
+            return False
+        try:
+            mtime = os.stat (self._filename).st_mtime
+        except:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        self._config = ConfigParser.RawConfigParser()
+        self.init (self._filename)
+        return True
+
     def option (self, func):
         """Decorator to register an option with this Config object."""
         self._options[func.__name__] = func
@@ -56,6 +85,10 @@ class Config (object):
         fp = open(self._filename, 'w')
         self._config.write(fp)
         fp.close()
+        try:
+            self._mtime = os.stat (self._filename).st_mtime
+        except:
+            self._mtime = None
 
     def get_raw_option (self, name):
         try:
@@ -64,11 +97,19 @@ class Config (object):
             return None
 
     def __getattr__ (self, name):
+        if name.startswith('_'):
+            raise AttributeError ('This \'Config\' object has no attribute \'%s\'' % name)
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
         try:
             func = self._options[name]
-            return func (self, self.get_raw_option (name))
+            val = func (self, self.get_raw_option (name))
         except:
             raise AttributeError ('This \'Config\' object has no attribute \'%s\'' % name)
+        self._cache[name] = val
+        return val
 
     def __setattr__ (self, name, value):
         if name.startswith('_'):
@@ -77,6 +118,8 @@ class Config (object):
             if not self._config.has_section('config'):
                 self._config.add_section ('config')
             self._config.set ('config', name, value)
+            # Options may be computed from other options, so clear them all.
+            self._cache = {}
         
 config = Config ()
 
@@ -125,5 +168,20 @@ def web_root_url (config, url):
     else:
         return url + '/'
 
+@config.option
+def web_session_secret (config, val):
+    """The secret key used to sign session cookies"""
+    return val
+
+@config.option
+def profile_rate (config, val):
+    """The fraction of timed requests to profile with cProfile"""
+    return val
+
+@config.option
+def profile_dir (config, val):
+    """The directory to write profile data to"""
+    return (val is not None) and val or '.'
+
 import sys
 sys.modules[__name__] = config
@@ -17,40 +17,261 @@
 #
 
 import os
+import sys
+import time
+
+_generation = 0
+
+def get_generation ():
+    """
+    Get a number that changes whenever the lists of extensions may change
+
+    Code that caches something computed from get_extensions can keep the
+    generation it was computed at, and compute it again when this changes.
+    """
+    return _generation
+
+def _invalidate ():
+    global _generation
+    _generation += 1
+    ExtensionMeta._extensions.clear ()
+
+class ExtensionMeta (type):
+    """
+    Metaclass for extension points
+
+    This numbers each extension class as it is defined, so extensions are
+    always listed in definition order, and it invalidates the cached lists
+    of extensions whenever a new extension class is defined.
+    """
+    _counter = 0
+    _extensions = {}
+    _classes = []
+
+    def __init__ (cls, name, bases, dct):
+        super (ExtensionMeta, cls).__init__ (name, bases, dct)
+        ExtensionMeta._counter += 1
+        cls._extension_index = ExtensionMeta._counter
+        ExtensionMeta._classes.append (cls)
+        _invalidate ()
+
 
 class ExtensionPoint (object):
-    _disabled = []
-    _disabled_pkgs = []
+    __metaclass__ = ExtensionMeta
+    _disabled = set()
+    _disabled_pkgs = set()
 
     @classmethod
     def get_extensions (cls):
+        if len(_pending) > 0:
+            _import_pending (cls)
+        try:
+            return list (ExtensionMeta._extensions[cls])
+        except KeyError:
+            pass
         extensions = []
-        for subcls in cls.__subclasses__():
-            if subcls not in cls._disabled:
+        subclasses = sorted (cls.__subclasses__(),
+                             key=lambda subcls: subcls._extension_index)
+        for subcls in subclasses:
+            if subcls not in ExtensionPoint._disabled:
                 extensions.append (subcls)
-            extensions = extensions + subcls.get_extensions()
+            extensions.extend (subcls.get_extensions())
+        ExtensionMeta._extensions[cls] = tuple (extensions)
         return extensions
 
     @classmethod
     def disable_extension (cls, ext):
-        cls._disabled.append (ext)
+        ExtensionPoint._disabled.add (ext)
+        _invalidate ()
 
     @classmethod
     def disable_package (cls, pkg):
-        cls._disabled_pkgs.append (pkg)
+        ExtensionPoint._disabled_pkgs.add (pkg)
+        _invalidate ()
+
+
+_pending = {}
+_commands = {}
+_import_times = {}
+_import_errors = {}
+
+def _qualname (cls):
+    return cls.__module__ + '.' + cls.__name__
+
+def _import_module (modname):
+    """Import a module, recording how long it took and any error"""
+    if modname in sys.modules:
+        return True
+    start = time.time ()
+    try:
+        __import__ (modname)
+    except ImportError, err:
+        _import_errors[modname] = str(err)
+        return False
+    finally:
+        _import_times[modname] = time.time () - start
+    return True
 
+def _import_pending (cls):
+    modnames = _pending.pop (_qualname (cls), None)
+    if modnames is None:
+        return
+    for modname in sorted (modnames):
+        if modname in ExtensionPoint._disabled_pkgs:
+            continue
+        _import_module (modname)
 
-def import_extensions (base, domain):
+def _find_modules (base, domain):
+    """
+    Find the extension modules for a domain, along with a signature of
+    the modification times of every module file in their packages
+    """
     plugdir = os.path.dirname (base.__file__)
-    for pkg in os.listdir (plugdir):
-        if os.path.isdir (os.path.join (plugdir, pkg)):
-            try:
-                pkgname = base.__name__ + '.' + pkg
-                if pkgname in ExtensionPoint._disabled_pkgs:
-                    continue
-                pkgname += '.' + domain
-                if pkgname in ExtensionPoint._disabled_pkgs:
-                    continue
-                __import__ (pkgname)
-            except ImportError:
-                pass
+    signature = []
+    modules = []
+    for pkg in sorted (os.listdir (plugdir)):
+        pkgdir = os.path.join (plugdir, pkg)
+        if not os.path.isdir (pkgdir):
+            continue
+        pkgname = base.__name__ + '.' + pkg
+        if pkgname in ExtensionPoint._disabled_pkgs:
+            continue
+        pkgname += '.' + domain
+        if pkgname in ExtensionPoint._disabled_pkgs:
+            continue
+        for filename in (domain + '.py', os.path.join (domain, '__init__.py')):
+            if os.path.exists (os.path.join (pkgdir, filename)):
+                modules.append (pkgname)
+                break
+        else:
+            continue
+        # Extensions can live in any module the domain module imports, so
+        # a change to any file in the package invalidates the manifest.
+        for dirpath, dirnames, filenames in os.walk (pkgdir):
+            dirnames.sort ()
+            for filename in sorted (filenames):
+                if filename.endswith ('.py'):
+                    filename = os.path.join (dirpath, filename)
+                    signature.append ([os.path.relpath (filename, plugdir),
+                                       os.stat (filename).st_mtime])
+    return (modules, signature)
+
+def _scan_modules (modules):
+    """
+    Import modules and record the extensions each one defines
+
+    Modules that fail to import are recorded with None, so they are
+    tried again, and their errors reported, each time the manifest is used.
+    Only classes defined in the module's plugin package are recorded for
+    it, including those in helper modules it imports, but not framework
+    classes that its import happened to pull in.
+    """
+    entries = {}
+    for modname in modules:
+        pkgprefix = modname.rsplit ('.', 1)[0] + '.'
+        before = len(ExtensionMeta._classes)
+        if not _import_module (modname):
+            entries[modname] = None
+            continue
+        entries[modname] = []
+        for cls in ExtensionMeta._classes[before:]:
+            if not cls.__module__.startswith (pkgprefix):
+                continue
+            command = getattr (cls, 'command', None)
+            if not isinstance (command, basestring):
+                command = None
+            points = [_qualname (point) for point in cls.__mro__[1:]
+                      if isinstance (point, ExtensionMeta)]
+            entries[modname].append ({'class': _qualname (cls),
+                                      'points': points,
+                                      'command': command})
+    return entries
+
+def import_extensions (base, domain, lazy=False, manifest=None):
+    """
+    Import the extension modules for a domain from each package in base
+
+    If lazy is True, a manifest of which modules provide which extensions
+    is cached in the file manifest, by default in the directory of base.
+    As long as no plugin files have changed, modules are then only imported
+    when get_extensions is called on an extension point they provide, or
+    when import_command is called for a command they provide.
+    """
+    (modules, signature) = _find_modules (base, domain)
+    if not lazy:
+        for modname in modules:
+            _import_module (modname)
+        return
+
+    import json
+    if manifest is None:
+        manifest = os.path.join (os.path.dirname (base.__file__),
+                                 '.blinq-manifest-' + domain)
+    entries = None
+    try:
+        fp = open (manifest)
+        data = json.load (fp)
+        fp.close ()
+        if data.get ('signature') == signature and data.get ('modules') == modules:
+            entries = data['entries']
+    except:
+        pass
+
+    if entries is None:
+        entries = _scan_modules (modules)
+        try:
+            fp = open (manifest, 'w')
+            json.dump ({'signature': signature, 'modules': modules,
+                        'entries': entries}, fp)
+            fp.close ()
+        except:
+            pass
+        return
+
+    for modname in modules:
+        if entries.get (modname) is None:
+            # The module failed to import when the manifest was made, so
+            # try it again now, which records any error for the report.
+            _import_module (modname)
+            continue
+        if len(entries[modname]) == 0:
+            # Without extensions, a module is only useful for what it does
+            # when imported, so don't defer it.
+            _import_module (modname)
+            continue
+        for entry in entries[modname]:
+            for point in entry['points']:
+                _pending.setdefault (point, set()).add (modname)
+            if entry['command'] is not None:
+                _commands.setdefault (entry['command'], set()).add (modname)
+    _invalidate ()
+
+def import_command (command):
+    """
+    Import any modules deferred by a lazy import_extensions that provide
+    an extension with the command attribute command
+    """
+    for modname in sorted (_commands.pop (command, [])):
+        _import_module (modname)
+
+def get_import_times ():
+    """Get a dictionary mapping module names to their import times in seconds"""
+    return _import_times.copy ()
+
+def get_import_errors ():
+    """Get a dictionary mapping module names to the errors importing them"""
+    return _import_errors.copy ()
+
+def format_import_report ():
+    """Get a text report of module import times, slowest first"""
+    lines = []
+    total = 0.0
+    for modname, secs in sorted (_import_times.items(),
+                                 key=lambda item: item[1], reverse=True):
+        total += secs
+        line = '%8.2f ms  %s' % (secs * 1000, modname)
+        if modname in _import_errors:
+            line += '  (ImportError: %s)' % _import_errors[modname]
+        lines.append (line)
+    lines.append ('%8.2f ms  total' % (total * 1000))
+    return '\n'.join (lines) + '\n'
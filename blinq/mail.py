@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""Queued mail delivery over pooled SMTP connections"""
+
+import collections
+import email.header
+import email.mime.text
+import email.utils
+import smtplib
+import socket
+import threading
+import time
+
+import blinq.config
+import blinq.utils
+
+
+class MailConnection (object):
+    """
+    A persistent SMTP connection configured from blinq.config
+
+    The connection is opened on first use.  If it has been idle for more
+    than check_interval seconds, it is checked with NOOP before it is used,
+    and reopened if the server has gone away.
+    """
+    check_interval = 30
+
+    def __init__ (self, **kw):
+        super (MailConnection, self).__init__ (**kw)
+        self._smtp = None
+        self._last_used = 0
+
+    def _connect (self):
+        server = blinq.config.mail_server
+        port = int (blinq.config.mail_port)
+        if blinq.config.mail_encryption == 'ssl':
+            smtp = smtplib.SMTP_SSL (server, port)
+        else:
+            smtp = smtplib.SMTP (server, port)
+            if blinq.config.mail_encryption == 'tsl':
+                smtp.ehlo ()
+                smtp.starttls ()
+                smtp.ehlo ()
+        if blinq.config.mail_username is not None:
+            smtp.login (blinq.config.mail_username,
+                        blinq.config.mail_password or '')
+        self._smtp = smtp
+
+    def _is_alive (self):
+        try:
+            return self._smtp.noop ()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def get_smtp (self):
+        """Get a working smtplib.SMTP object, connecting if needed"""
+        if self._smtp is not None:
+            if time.time () - self._last_used > self.check_interval:
+                if not self._is_alive ():
+                    self.close ()
+        if self._smtp is None:
+            self._connect ()
+        self._last_used = time.time ()
+        return self._smtp
+
+    def close (self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit ()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._smtp = None
+
+
+class Mailer (object):
+    """
+    Queue of outgoing mail, sent in batches over one SMTP session
+
+    Messages passed to send are queued and returned immediately.  If
+    background is True, a thread sends them, up to batch_size at a time
+    over one connection.  Temporary failures are retried up to max_retries
+    times, waiting retry_delay seconds and doubling the wait each time.
+    Call flush to wait until the queue is empty; without a background
+    thread, flush sends the queued messages itself.
+
+    Messages that could not be sent are kept in the failed list as tuples
+    of the message and the exception.
+    """
+    batch_size = 50
+    max_retries = 5
+    retry_delay = 1.0
+    idle_timeout = 60
+
+    def __init__ (self, background=True, connection=None, **kw):
+        for key in ('batch_size', 'max_retries', 'retry_delay', 'idle_timeout'):
+            if key in kw:
+                setattr (self, key, kw.pop (key))
+        super (Mailer, self).__init__ (**kw)
+        self.background = background
+        self.connection = connection or MailConnection ()
+        self.failed = []
+        self._queue = collections.deque ()
+        self._pending = 0
+        self._cond = threading.Condition ()
+        self._thread = None
+        self._closing = False
+
+    def send (self, to_addrs, subject, body, from_addr=None, headers=None):
+        """Queue a plain text message to one address or a list of addresses"""
+        if isinstance (to_addrs, basestring):
+            to_addrs = [to_addrs]
+        if from_addr is None:
+            from_addr = blinq.config.mail_from
+        msg = email.mime.text.MIMEText (blinq.utils.utf8enc (body), 'plain', 'utf-8')
+        msg['Subject'] = email.header.Header (subject, 'utf-8')
+        msg['From'] = from_addr
+        msg['To'] = ', '.join (to_addrs)
+        msg['Date'] = email.utils.formatdate (localtime=True)
+        if headers is not None:
+            for key, val in headers.items ():
+                msg[key] = val
+        self.send_message (msg, from_addr, to_addrs)
+
+    def send_message (self, msg, from_addr, to_addrs):
+        """Queue an email.message.Message object"""
+        self._cond.acquire ()
+        try:
+            self._queue.append ((msg, from_addr, to_addrs))
+            self._pending += 1
+            if self.background and self._thread is None:
+                self._thread = threading.Thread (target=self._run)
+                self._thread.daemon = True
+                self._thread.start ()
+            self._cond.notify_all ()
+        finally:
+            self._cond.release ()
+
+    def flush (self, timeout=None):
+        """
+        Wait until every queued message has been sent or has failed.
+        Returns False if timeout seconds pass first.
+        """
+        if self._thread is None:
+            while self._send_batch ():
+                pass
+            self.connection.close ()
+            return True
+        end = timeout is not None and time.time () + timeout or None
+        self._cond.acquire ()
+        try:
+            while self._pending > 0:
+                if end is not None:
+                    if time.time () >= end:
+                        return False
+                    self._cond.wait (end - time.time ())
+                else:
+                    self._cond.wait (1)
+            return True
+        finally:
+            self._cond.release ()
+
+    def close (self):
+        """Send any queued messages, then stop the background thread"""
+        self.flush ()
+        self._cond.acquire ()
+        try:
+            self._closing = True
+            self._cond.notify_all ()
+        finally:
+            self._cond.release ()
+        if self._thread is not None:
+            self._thread.join ()
+            self._thread = None
+        self._closing = False
+        self.connection.close ()
+
+    def _run (self):
+        while True:
+            idle = False
+            self._cond.acquire ()
+            try:
+                if len(self._queue) == 0 and not self._closing:
+                    self._cond.wait (self.idle_timeout)
+                if len(self._queue) == 0:
+                    if self._closing:
+                        return
+                    idle = True
+            finally:
+                self._cond.release ()
+            if idle:
+                # Don't hold a connection open while idle.  QUIT is a round
+                # trip, so do it outside the lock to keep send from blocking.
+                self.connection.close ()
+            else:
+                self._send_batch ()
+
+    def _send_batch (self):
+        self._cond.acquire ()
+        try:
+            batch = []
+            while len(self._queue) > 0 and len(batch) < self.batch_size:
+                batch.append (self._queue.popleft ())
+        finally:
+            self._cond.release ()
+        if len(batch) == 0:
+            return False
+        for msg, from_addr, to_addrs in batch:
+            try:
+                self._deliver (msg, from_addr, to_addrs)
+            except Exception, err:
+                # Fail just this message, so the thread keeps running and
+                # _pending still reaches 0 for flush
+                self.failed.append ((msg, err))
+            self._cond.acquire ()
+            try:
+                self._pending -= 1
+                self._cond.notify_all ()
+            finally:
+                self._cond.release ()
+        return True
+
+    def _deliver (self, msg, from_addr, to_addrs):
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                smtp = self.connection.get_smtp ()
+                smtp.sendmail (from_addr, to_addrs, msg.as_string ())
+                return
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError), err:
+                code = getattr (err, 'smtp_code', None)
+                if code is None or code >= 500 or attempt >= self.max_retries:
+                    self.failed.append ((msg, err))
+                    return
+            except (smtplib.SMTPException, socket.error), err:
+                self.connection.close ()
+                if attempt >= self.max_retries:
+                    self.failed.append ((msg, err))
+                    return
+            attempt += 1
+            time.sleep (delay)
+            delay *= 2
+
+
+_mailer = None
+
+def get_mailer ():
+    """Get the shared Mailer for this process"""
+    global _mailer
+    if _mailer is None:
+        _mailer = Mailer ()
+    return _mailer
+
+def send_mail (to_addrs, subject, body, from_addr=None, headers=None):
+    """Queue a message on the shared Mailer"""
+    get_mailer ().send (to_addrs, subject, body, from_addr=from_addr, headers=headers)
@@ -18,29 +18,113 @@
 
 import os
 import os.path
+import UserDict
 
 import blinq.ext
 
 
+class EnvironOverlay (UserDict.DictMixin, object):
+    """
+    Copy-on-write view of an environment dictionary
+
+    Lookups read through to the base dictionary, which is never modified.
+    Only values that are set or deleted on the overlay are stored in it.
+    DictMixin provides the rest of the dictionary interface, such as
+    iteritems and setdefault.
+    """
+    __slots__ = ('_base', '_overrides', '_deleted')
+
+    def __init__ (self, base):
+        self._base = base
+        self._overrides = {}
+        self._deleted = set()
+
+    def __getitem__ (self, key):
+        try:
+            return self._overrides[key]
+        except KeyError:
+            if key in self._deleted:
+                raise
+            return self._base[key]
+
+    def get (self, key, default=None):
+        try:
+            return self._overrides[key]
+        except KeyError:
+            if key in self._deleted:
+                return default
+            return self._base.get (key, default)
+
+    def __contains__ (self, key):
+        if key in self._overrides:
+            return True
+        if key in self._deleted:
+            return False
+        return key in self._base
+
+    has_key = __contains__
+
+    def __setitem__ (self, key, value):
+        self._overrides[key] = value
+        self._deleted.discard (key)
+
+    def __delitem__ (self, key):
+        if key not in self:
+            raise KeyError (key)
+        self._overrides.pop (key, None)
+        self._deleted.add (key)
+
+    def keys (self):
+        keys = [key for key in self._base.keys()
+                if key not in self._deleted and key not in self._overrides]
+        return keys + self._overrides.keys()
+
+    def __iter__ (self):
+        return iter (self.keys())
+
+    def __len__ (self):
+        return len (self.keys())
+
+    def __eq__ (self, other):
+        return self.copy() == other
+
+    def __ne__ (self, other):
+        return not self == other
+
+    def __repr__ (self):
+        return repr (self.copy())
+
+    def copy (self):
+        return dict (self.items())
+
+
 class Request (object):
     """Abstract base class for all requests"""
+    __slots__ = ('environ', '_data')
+
     def __init__ (self, **kw):
-        self.environ = kw.pop('environ', os.environ).copy()
+        self.environ = EnvironOverlay (kw.pop('environ', os.environ))
         super (Request, self).__init__(**kw)
-        self._data = {}
+        self._data = None
 
     def getenv (self, key):
         return self.environ.get (key)
 
     def set_data (self, key, val):
+        if self._data is None:
+            self._data = {}
         self._data[key] = val
 
     def get_data (self, key, default=None):
+        if self._data is None:
+            return default
         return self._data.get (key, default)
 
 
 class Response (object):
     """Abstract base class for all responses"""
+    __slots__ = ('request', 'return_code', 'payload', '_content_type')
+
     def __init__ (self, request, **kw):
         super (Response, self).__init__(**kw)
         self.request = request
@@ -83,14 +167,38 @@ class TextPayload (Payload):
     def __init__ (self, **kw):
         super (TextPayload, self).__init__(**kw)
         self.content_type = 'text/plain; charset=utf-8'
-        self._content = ''
+        self._content = []
 
     def __iadd__ (self, txt):
-        self._content += str(txt)
+        self._content.append (str(txt))
         return self
 
     def output (self, res):
-        res.write (self._content)
+        res.write (''.join (self._content))
+
+
+class StreamPayload (Payload):
+    """
+    Payload that writes chunks from an iterable as they are produced
+
+    The iterable may be a generator, in which case each chunk is written
+    to the response as soon as it is yielded, and the complete content is
+    never held in memory.
+    """
+    def __init__ (self, chunks=None, **kw):
+        content_type = kw.pop ('content_type', 'text/plain; charset=utf-8')
+        super (StreamPayload, self).__init__(**kw)
+        self.content_type = content_type
+        self._chunks = chunks
+
+    def set_chunks (self, chunks):
+        self._chunks = chunks
+
+    def output (self, res):
+        if self._chunks is None:
+            return
+        for chunk in self._chunks:
+            res.write (chunk)
 
 
 class Responder (blinq.ext.ExtensionPoint):
@@ -98,3 +206,13 @@ class Responder (blinq.ext.ExtensionPoint):
     def respond (cls, request):
         raise NotImplementedError ('%s does not provide the respond method.'
                                    % cls.__name__)
+
+    @classmethod
+    def respond_future (cls, request, executor):
+        """
+        Start responding to a request, returning a blinq.reqs.futures.Future
+        for the response.  By default, this runs respond on executor.
+        Responders that wait on slow backends can override this to submit
+        that work to executor and chain the response onto it.
+        """
+        return executor.submit (cls.respond, request)
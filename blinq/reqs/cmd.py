@@ -18,24 +18,41 @@
 
 import optparse
 import os.path
+import shlex
 import sys
+import traceback
 
 import blinq.reqs
+import blinq.reqs.timing
 import blinq.utils
 
 
 class CmdRequest (blinq.reqs.Request):
+    __slots__ = ('argv', '_common_parser', '_responders', '_sorted_responders',
+                 '_tool_parsers', '_tool_parser', '_tool', '_common_options',
+                 '_common_args', '_tool_options', '_tool_args', '_has_tool_options')
+
     def __init__ (self, **kw):
         self.argv = kw.pop ('argv', sys.argv[1:])
+        parent = kw.pop ('parent', None)
         super (CmdRequest, self).__init__ (**kw)
-        self._common_parser = OptionParser (formatter=OptionParser.CommonFormatter())
-        self._common_parser.disable_interspersed_args ()
-        self._common_parser.remove_option ('-h')
-        self._common_parser.add_option ('-h', '--help',
-                                        dest='_is_help_request',
-                                        action='store_true',
-                                        default=False,
-                                        help='print this help message and exit')
+        if parent is not None:
+            self._common_parser = parent._common_parser
+            self._responders = parent._responders
+            self._sorted_responders = parent._sorted_responders
+            self._tool_parsers = parent._tool_parsers
+        else:
+            self._common_parser = OptionParser (formatter=OptionParser.CommonFormatter())
+            self._common_parser.disable_interspersed_args ()
+            self._common_parser.remove_option ('-h')
+            self._common_parser.add_option ('-h', '--help',
+                                            dest='_is_help_request',
+                                            action='store_true',
+                                            default=False,
+                                            help='print this help message and exit')
+            self._responders = {}
+            self._sorted_responders = []
+            self._tool_parsers = {}
         self._tool_parser = OptionParser (formatter=OptionParser.ToolFormatter())
         self._tool_parser.remove_option ('-h')
         self._tool = None
@@ -43,9 +60,19 @@ class CmdRequest (blinq.reqs.Request):
         self._common_args = []
         self._tool_options = {}
         self._tool_args = []
-        self._responders = []
         self._has_tool_options = False
 
+    def new_request (self, argv, **kw):
+        """
+        Create a request for another command line in the same process
+
+        The new request shares this request's common options, its tool
+        responders, and the option parsers already built for each command.
+        """
+        if 'environ' not in kw:
+            kw['environ'] = self.environ
+        return self.__class__ (argv=argv, parent=self, **kw)
+
     def set_usage (self, usage):
         self._common_parser.set_usage (usage)
 
@@ -92,13 +119,33 @@ class CmdRequest (blinq.reqs.Request):
         return self._tool_args
 
     def add_tool_responder (self, responder):
-        self._responders.append (responder)
+        self._responders[responder.command] = responder
+        del self._sorted_responders[:]
+
+    def get_tool_responder (self, command):
+        return self._responders.get (command)
 
     def get_tool_responders (self):
-        return blinq.utils.attrsorted (self._responders, 'command')
+        if len(self._sorted_responders) != len(self._responders):
+            self._sorted_responders[:] = blinq.utils.attrsorted (self._responders.values(),
+                                                                 'command')
+        return list (self._sorted_responders)
+
+    def _use_tool_parser (self, command):
+        """Switch to the saved tool option parser for a command, if any"""
+        try:
+            (self._tool_parser, self._has_tool_options) = self._tool_parsers[command]
+            return True
+        except KeyError:
+            return False
+
+    def _save_tool_parser (self, command):
+        self._tool_parsers[command] = (self._tool_parser, self._has_tool_options)
 
 
 class CmdResponse (blinq.reqs.Response):
+    __slots__ = ('_error_text',)
+
     def __init__ (self, request, **kw):
         super (CmdResponse, self).__init__ (request, **kw)
         self._error_text = None
@@ -115,6 +162,8 @@ class CmdResponse (blinq.reqs.Response):
 
 
 class CmdErrorResponse (CmdResponse):
+    __slots__ = ()
+
     def __init__ (self, request, error, **kw):
         super (CmdErrorResponse, self).__init__ (request, **kw)
         self._error_text = error
@@ -140,20 +189,23 @@ class CmdResponder (blinq.reqs.Responder):
 
         responder = None
         if tool is not None:
-            for res in request.get_tool_responders ():
-                if res.command == tool:
-                    responder = res
-                    break
+            start = blinq.reqs.timing.start ()
+            responder = request.get_tool_responder (tool)
+            if start is not None:
+                blinq.reqs.timing.record (tool, 'dispatch',
+                                          blinq.reqs.timing.elapsed (start))
 
         if responder is None and tool is not None:
             return CmdErrorResponse (request, '%s is not a valid command.' % tool)
 
         if responder is not None:
-            try:
-                responder.set_usage (request)
-                responder.add_tool_options (request)
-            except NotImplementedError:
-                pass
+            responder.set_usage (request)
+            if not request._use_tool_parser (tool):
+                try:
+                    responder.add_tool_options (request)
+                except NotImplementedError:
+                    pass
+                request._save_tool_parser (tool)
 
         if request.is_help_request():
             request.print_help()
@@ -168,6 +220,59 @@ class CmdResponder (blinq.reqs.Responder):
         return response
 
 
+def run_batch (request, fp=None, respond=None):
+    """
+    Run many commands in one process, one command line per line of fp
+
+    Each line is split like a shell command line and run with a request
+    created by request.new_request, so loaded extensions, responders, and
+    option parsers are reused.  Blank lines and lines starting with # are
+    skipped.  Errors are printed as they occur, and a line that fails,
+    even with an exception or a bad option, does not stop the batch.  The
+    return value is 0 if every command succeeded, and otherwise the last
+    non-zero return code.
+    """
+    if fp is None:
+        fp = sys.stdin
+    if respond is None:
+        respond = CmdResponder.respond
+    retcode = 0
+    for line in fp:
+        line = line.strip ()
+        if line == '' or line.startswith ('#'):
+            continue
+        try:
+            argv = shlex.split (line)
+        except ValueError, err:
+            # Unbalanced quotes
+            print >>sys.stderr, '%s: %s' % (line, err)
+            retcode = 1
+            continue
+        try:
+            subreq = request.new_request (argv)
+            subreq.parse_common_options ()
+            response = respond (subreq)
+        except SystemExit, err:
+            # optparse exits on bad options, after printing its own message
+            if err.code not in (None, 0):
+                if isinstance (err.code, int):
+                    retcode = err.code
+                else:
+                    print >>sys.stderr, err.code
+                    retcode = 1
+            continue
+        except Exception:
+            print >>sys.stderr, '%s:' % line
+            traceback.print_exc ()
+            retcode = 1
+            continue
+        if response.get_error () is not None:
+            response.print_error (response.get_error ())
+        if response.return_code != 0:
+            retcode = response.return_code
+    return retcode
+
+
 class OptionParser (optparse.OptionParser):
     class CommonFormatter (optparse.IndentedHelpFormatter):
         def format_usage (self, usage):
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""Streaming parsers for POSTed form data"""
+
+import cgi
+import tempfile
+import urllib
+
+import blinq.utils
+
+
+class FormError (Exception):
+    """Raised when a request body is malformed or exceeds a limit"""
+    def __init__ (self, desc, http_status=400):
+        super (FormError, self).__init__ (desc)
+        self.desc = desc
+        self.http_status = http_status
+
+
+class FormFile (object):
+    """
+    An uploaded file from a multipart form
+
+    The contents are held in a spooled temporary file, which stays in
+    memory until it grows past the parser's spool_size and is then moved
+    to disk.  The file is positioned at the beginning once parsing ends.
+    """
+    def __init__ (self, name, filename, content_type, fp):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = fp
+        self.size = 0
+
+    def read (self, *args):
+        return self.file.read (*args)
+
+    def close (self):
+        self.file.close ()
+
+
+class FormData (dict):
+    """
+    A dictionary of form fields that keeps every value
+
+    Indexing a FormData gets the first value for a field, as the old
+    dictionary of POST data did.  Use getlist to get all values.
+    """
+    def __init__ (self):
+        super (FormData, self).__init__ ()
+        self._lists = {}
+        self._count = 0
+
+    def add (self, key, value):
+        if key not in self._lists:
+            self._lists[key] = []
+            dict.__setitem__ (self, key, value)
+        self._lists[key].append (value)
+        self._count += 1
+
+    def getlist (self, key):
+        return list (self._lists.get (key, []))
+
+    def getfirst (self, key, default=None):
+        return self.get (key, default)
+
+    def close (self):
+        """Close any temporary files held by uploaded files"""
+        for values in self._lists.values():
+            for value in values:
+                if isinstance (value, FormFile):
+                    value.close ()
+
+
+class FormParser (object):
+    """
+    Incremental parser for urlencoded and multipart request bodies
+
+    The body is read in chunks of chunk_size bytes, so it is never held
+    in memory all at once.  A FormError is raised if the body has more
+    than max_fields fields, if a non-file field is larger than
+    max_field_size, or if the whole body is larger than max_total_size.
+    Uploaded files larger than spool_size are written to disk.
+    """
+    chunk_size = 64 * 1024
+    max_fields = 1000
+    max_field_size = 1024 * 1024
+    max_total_size = 64 * 1024 * 1024
+    spool_size = 256 * 1024
+
+    def __init__ (self, **kw):
+        for key in ('chunk_size', 'max_fields', 'max_field_size',
+                    'max_total_size', 'spool_size'):
+            if key in kw:
+                setattr (self, key, kw.pop (key))
+        super (FormParser, self).__init__ (**kw)
+
+    def parse (self, fp, environ):
+        """
+        Parse a request body from fp, returning a FormData object
+
+        A missing or invalid CONTENT_LENGTH is taken to mean an empty body,
+        since WSGI servers may block reading past the end of the body.
+        """
+        ctype, params = cgi.parse_header (environ.get ('CONTENT_TYPE', ''))
+        try:
+            length = int (environ.get ('CONTENT_LENGTH'))
+        except (TypeError, ValueError):
+            length = 0
+        if length > self.max_total_size:
+            raise FormError ('Request body is too large.', 413)
+        data = FormData ()
+        if ctype == 'application/x-www-form-urlencoded':
+            self._parse_urlencoded (self._read_chunks (fp, length), data)
+        elif ctype == 'multipart/form-data':
+            boundary = params.get ('boundary')
+            if not boundary:
+                raise FormError ('Missing multipart boundary.')
+            self._parse_multipart (self._read_chunks (fp, length), boundary, data)
+        return data
+
+    def _read_chunks (self, fp, length):
+        total = 0
+        while total < length:
+            chunk = fp.read (min (self.chunk_size, length - total))
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > self.max_total_size:
+                raise FormError ('Request body is too large.', 413)
+            yield chunk
+
+    def _add_field (self, data, key, value):
+        if data._count >= self.max_fields:
+            raise FormError ('Too many form fields.', 413)
+        data.add (key, value)
+
+    def _parse_urlencoded (self, chunks, data):
+        buf = ''
+        for chunk in chunks:
+            buf += chunk
+            pairs = buf.replace (';', '&').split ('&')
+            buf = pairs.pop ()
+            if len(buf) > self.max_field_size:
+                raise FormError ('Form field is too large.', 413)
+            self._add_pairs (data, pairs)
+        self._add_pairs (data, [buf])
+
+    def _add_pairs (self, data, pairs):
+        keys = []
+        values = []
+        for pair in pairs:
+            if '=' not in pair:
+                continue
+            key, value = pair.split ('=', 1)
+            if value == '':
+                continue
+            keys.append (urllib.unquote_plus (key))
+            values.append (urllib.unquote_plus (value))
+        values = blinq.utils.utf8dec_list (values)
+        for i in range (len(keys)):
+            self._add_field (data, keys[i], values[i])
+
+    def _parse_multipart (self, chunks, boundary, data):
+        delim = '--' + boundary
+        buf = ''
+        state = 'preamble'
+        part = None
+        for chunk in chunks:
+            buf += chunk
+            while True:
+                if state == 'preamble':
+                    idx = buf.find (delim)
+                    if idx < 0:
+                        buf = buf[-len(delim):]
+                        break
+                    buf = buf[idx + len(delim):]
+                    state = 'delimiter'
+                elif state == 'delimiter':
+                    if len(buf) < 2:
+                        break
+                    if buf.startswith ('--'):
+                        return
+                    idx = buf.find ('\r\n')
+                    if idx < 0:
+                        break
+                    buf = buf[idx + 2:]
+                    state = 'headers'
+                elif state == 'headers':
+                    idx = buf.find ('\r\n\r\n')
+                    if idx < 0:
+                        if len(buf) > self.max_field_size:
+                            raise FormError ('Form part headers are too large.', 413)
+                        break
+                    part = self._start_part (buf[:idx])
+                    buf = buf[idx + 4:]
+                    state = 'body'
+                elif state == 'body':
+                    idx = buf.find ('\r\n' + delim)
+                    if idx < 0:
+                        keep = len(delim) + 1
+                        if len(buf) > keep:
+                            self._write_part (part, buf[:-keep])
+                            buf = buf[-keep:]
+                        break
+                    self._write_part (part, buf[:idx])
+                    self._end_part (part, data)
+                    part = None
+                    buf = buf[idx + 2 + len(delim):]
+                    state = 'delimiter'
+        if state != 'preamble':
+            raise FormError ('Truncated multipart body.')
+
+    def _start_part (self, headers):
+        disposition = None
+        ctype = None
+        for line in headers.split ('\r\n'):
+            if ':' not in line:
+                continue
+            key, value = line.split (':', 1)
+            key = key.strip().lower()
+            if key == 'content-disposition':
+                disposition = cgi.parse_header (value.strip())
+            elif key == 'content-type':
+                ctype = value.strip()
+        if disposition is None or 'name' not in disposition[1]:
+            return {'name': None}
+        name = disposition[1]['name']
+        filename = disposition[1].get ('filename')
+        if filename is not None:
+            fp = tempfile.SpooledTemporaryFile (max_size=self.spool_size)
+            return {'name': name,
+                    'file': FormFile (name, blinq.utils.utf8dec (filename), ctype, fp)}
+        return {'name': name, 'value': [], 'size': 0,
+                'decoder': blinq.utils.UTF8Decoder ()}
+
+    def _write_part (self, part, txt):
+        if part['name'] is None or txt == '':
+            return
+        if 'file' in part:
+            part['file'].file.write (txt)
+            part['file'].size += len(txt)
+        else:
+            part['value'].append (part['decoder'].decode (txt))
+            part['size'] += len(txt)
+            if part['size'] > self.max_field_size:
+                raise FormError ('Form field is too large.', 413)
+
+    def _end_part (self, part, data):
+        if part['name'] is None:
+            return
+        if 'file' in part:
+            part['file'].file.seek (0)
+            self._add_field (data, part['name'], part['file'])
+        else:
+            part['value'].append (part['decoder'].decode ('', True))
+            value = u''.join (part['value'])
+            if value != u'':
+                self._add_field (data, part['name'], value)
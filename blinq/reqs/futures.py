@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""
+Concurrent responders using futures and a thread pool
+
+Blinq runs on Python 2, which has no asyncio, so concurrency here comes
+from a pool of worker threads.  A responder can provide respond_future,
+which returns a Future for its response instead of blocking.  Responders
+that only provide respond are run on the pool, so slow responders overlap
+instead of each tying up a whole process.
+"""
+
+import Queue
+import sys
+import threading
+
+
+class Future (object):
+    """The result of a computation that may not have finished yet"""
+    def __init__ (self):
+        self._event = threading.Event ()
+        self._lock = threading.Lock ()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done (self):
+        return self._event.is_set ()
+
+    def set_result (self, result):
+        self._result = result
+        self._finish ()
+
+    def set_exception (self, exc_info):
+        """Set the exception for this Future, as returned by sys.exc_info"""
+        self._exc_info = exc_info
+        self._finish ()
+
+    def _finish (self):
+        self._lock.acquire ()
+        try:
+            self._event.set ()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release ()
+        for callback in callbacks:
+            callback (self)
+
+    def add_done_callback (self, callback):
+        """Call callback with this Future when it is done"""
+        self._lock.acquire ()
+        try:
+            if not self._event.is_set ():
+                self._callbacks.append (callback)
+                return
+        finally:
+            self._lock.release ()
+        callback (self)
+
+    def result (self, timeout=None):
+        """Wait for and return the result, or raise its exception"""
+        if not self._event.wait (timeout):
+            raise RuntimeError ('Timed out waiting for a result.')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def then (self, func):
+        """
+        Get a Future for the result of calling func with this Future's
+        result.  If func returns a Future, the new Future follows it.
+        """
+        future = Future ()
+        def callback (done):
+            try:
+                result = func (done.result ())
+            except:
+                future.set_exception (sys.exc_info ())
+                return
+            if isinstance (result, Future):
+                result.add_done_callback (
+                    lambda inner: _copy_future (inner, future))
+            else:
+                future.set_result (result)
+        self.add_done_callback (callback)
+        return future
+
+
+def _copy_future (source, target):
+    if source._exc_info is not None:
+        target.set_exception (source._exc_info)
+    else:
+        target.set_result (source._result)
+
+
+class Executor (object):
+    """A pool of worker threads that run functions and return Futures"""
+    def __init__ (self, workers=10, **kw):
+        super (Executor, self).__init__ (**kw)
+        self._queue = Queue.Queue ()
+        self._threads = []
+        for i in range (workers):
+            thread = threading.Thread (target=self._work)
+            thread.daemon = True
+            thread.start ()
+            self._threads.append (thread)
+
+    def submit (self, func, *args, **kw):
+        future = Future ()
+        self._queue.put ((future, func, args, kw))
+        return future
+
+    def _work (self):
+        while True:
+            item = self._queue.get ()
+            if item is None:
+                return
+            (future, func, args, kw) = item
+            try:
+                future.set_result (func (*args, **kw))
+            except:
+                future.set_exception (sys.exc_info ())
+
+    def shutdown (self, wait=True):
+        for thread in self._threads:
+            self._queue.put (None)
+        if wait:
+            for thread in self._threads:
+                thread.join ()
+        self._threads = []
+
+
+def respond_future (responder, request, executor):
+    """
+    Get a Future for a responder's response to a request
+
+    This calls the responder's respond_future method if it has one, and
+    otherwise runs its respond method on executor.
+    """
+    func = getattr (responder, 'respond_future', None)
+    if func is not None:
+        return func (request, executor)
+    return executor.submit (responder.respond, request)
+
+
+def serve_requests (responder, requests, executor=None):
+    """
+    Respond to many requests concurrently
+
+    The requests argument is an iterable of pairs of a request and the
+    file to output its response to.  Each response is output as soon as
+    it is ready.  This returns when every response has been output, and
+    returns a list of the exceptions raised while responding, if any.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = Executor ()
+    errors = []
+    outputs = []
+    for request, fp in requests:
+        future = respond_future (responder, request, executor)
+        outputs.append (future.then (lambda response, fp=fp: response.output (fp)))
+    for future in outputs:
+        try:
+            future.result ()
+        except:
+            errors.append (sys.exc_info ()[1])
+    if own_executor:
+        executor.shutdown ()
+    return errors
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""Caching of rendered web responses"""
+
+import collections
+import email.utils
+import hashlib
+import StringIO
+import threading
+import time
+
+import blinq.reqs
+import blinq.reqs.web
+
+
+class CachedPayload (blinq.reqs.Payload):
+    """Payload that writes out a previously rendered response body"""
+    def __init__ (self, entry, **kw):
+        super (CachedPayload, self).__init__ (**kw)
+        self.content_type = entry.content_type
+        self._body = entry.body
+
+    def output (self, res):
+        res.write (self._body)
+
+
+class CacheEntry (object):
+    """A rendered response body along with its validators"""
+    def __init__ (self, response, body, expires):
+        self.content_type = response.content_type
+        self.content_disposition = response.http_content_disposition
+        self.body = body
+        self.etag = '"%s"' % hashlib.md5 (body).hexdigest()
+        self.last_modified = int (time.time ())
+        self.expires = expires
+
+
+class ResponseCache (object):
+    """
+    Cache of rendered responses for a web responder
+
+    A ResponseCache has the same respond method as a responder, so it can
+    be used anywhere the responder it wraps is used.  Successful responses
+    to GET requests that don't set cookies are rendered once and kept for
+    ttl seconds, up to max_entries responses, evicting the least recently
+    used.  Responses are keyed on the request path and query, and on the
+    values of the cookies named in cookies.
+
+    Every response served from the cache has an ETag and a Last-Modified
+    header, and a 304 response is returned when the request has a matching
+    If-None-Match or If-Modified-Since header.
+    """
+    def __init__ (self, responder, ttl=60, max_entries=1000, cookies=(), **kw):
+        super (ResponseCache, self).__init__ (**kw)
+        self.responder = responder
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cookies = tuple (cookies)
+        self._entries = collections.OrderedDict ()
+        self._lock = threading.Lock ()
+
+    def get_key (self, request):
+        cookies = []
+        for cookie in self.cookies:
+            morsel = request.cookies.get (cookie)
+            cookies.append (morsel is not None and morsel.value or None)
+        return (tuple (request.path),
+                tuple (sorted (request.query.items())),
+                tuple (cookies))
+
+    def clear (self):
+        self._lock.acquire ()
+        try:
+            self._entries.clear ()
+        finally:
+            self._lock.release ()
+
+    def respond (self, request):
+        method = request.getenv ('REQUEST_METHOD') or 'GET'
+        if method not in ('GET', 'HEAD'):
+            return self.responder.respond (request)
+
+        key = self.get_key (request)
+        now = time.time ()
+        self._lock.acquire ()
+        try:
+            entry = self._entries.pop (key, None)
+            if entry is not None and entry.expires > now:
+                self._entries[key] = entry
+            else:
+                entry = None
+        finally:
+            self._lock.release ()
+
+        if entry is None:
+            response = self.responder.respond (request)
+            if (method != 'GET' or response.http_status not in (None, 200) or
+                len(response._cookies) > 0 or response.payload is None):
+                return response
+            fp = StringIO.StringIO ()
+            response.output_payload (fp=fp)
+            entry = CacheEntry (response, fp.getvalue(), now + self.ttl)
+            self._lock.acquire ()
+            try:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem (last=False)
+            finally:
+                self._lock.release ()
+
+        response = blinq.reqs.web.WebResponse (request)
+        response.http_etag = entry.etag
+        response.http_last_modified = entry.last_modified
+        if self._is_not_modified (request, entry):
+            response.http_status = 304
+            # Not sent, but needed to negotiate the same ETag and Vary
+            response.content_type = entry.content_type
+        else:
+            response.payload = CachedPayload (entry)
+            response.http_content_disposition = entry.content_disposition
+        return response
+
+    def _is_not_modified (self, request, entry):
+        match = request.getenv ('HTTP_IF_NONE_MATCH')
+        if match is not None:
+            for etag in match.split (','):
+                etag = etag.strip ()
+                if etag.startswith ('W/'):
+                    etag = etag[2:]
+                for encoding in ('-gzip"', '-deflate"'):
+                    if etag.endswith (encoding):
+                        etag = etag[:-len(encoding)] + '"'
+                if etag in (entry.etag, '*'):
+                    return True
+            return False
+        since = request.getenv ('HTTP_IF_MODIFIED_SINCE')
+        if since is not None:
+            since = email.utils.parsedate_tz (since)
+            if since is not None:
+                return entry.last_modified <= email.utils.mktime_tz (since)
+        return False
@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""Memoization of values computed by responders across requests"""
+
+import collections
+import cPickle
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import blinq.utils
+
+
+class MemoryMemoStore (object):
+    """
+    Memo store that keeps values in memory in this process
+
+    At most max_entries values are kept, evicting the least recently
+    used.  Values are stored as they are, without being copied, so they
+    should not be modified after they are cached.
+    """
+    def __init__ (self, max_entries=10000, **kw):
+        super (MemoryMemoStore, self).__init__ (**kw)
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict ()
+        self._tags = {}
+        self._lock = threading.Lock ()
+
+    def load (self, key):
+        self._lock.acquire ()
+        try:
+            entry = self._entries.pop (key)
+            if entry[0] is not None and entry[0] < time.time ():
+                self._remove (key, entry)
+                raise KeyError (key)
+            self._entries[key] = entry
+            return entry[1]
+        finally:
+            self._lock.release ()
+
+    def save (self, key, value, expires, tags):
+        self._lock.acquire ()
+        try:
+            old = self._entries.pop (key, None)
+            if old is not None:
+                self._remove (key, old)
+            self._entries[key] = (expires, value, tags)
+            for tag in tags:
+                self._tags.setdefault (tag, set()).add (key)
+            while len(self._entries) > self.max_entries:
+                self._remove (*self._entries.popitem (last=False))
+        finally:
+            self._lock.release ()
+
+    def delete (self, key):
+        self._lock.acquire ()
+        try:
+            entry = self._entries.pop (key, None)
+            if entry is not None:
+                self._remove (key, entry)
+        finally:
+            self._lock.release ()
+
+    def invalidate (self, tag):
+        self._lock.acquire ()
+        try:
+            for key in list (self._tags.get (tag, ())):
+                entry = self._entries.pop (key, None)
+                if entry is not None:
+                    self._remove (key, entry)
+        finally:
+            self._lock.release ()
+
+    def clear (self):
+        self._lock.acquire ()
+        try:
+            self._entries.clear ()
+            self._tags.clear ()
+        finally:
+            self._lock.release ()
+
+    def _remove (self, key, entry):
+        # Call with the lock held, after taking the entry out
+        for tag in entry[2]:
+            keys = self._tags.get (tag)
+            if keys is not None:
+                keys.discard (key)
+                if len(keys) == 0:
+                    del self._tags[tag]
+
+
+class MmapMemoStore (object):
+    """
+    Memo store in a memory-mapped file shared by processes on one host
+
+    The file holds a fixed table of buckets, each with ways slots of
+    slot_size bytes, so its size never changes.  Each key hashes to one
+    bucket, and saving to a full bucket evicts its least recently used
+    slot.  Values that don't fit in a slot after pickling are not stored.
+
+    Tags are hashed into a table of tag_slots counters.  Invalidating a
+    tag increments its counter, and values saved with an older counter
+    are then ignored.  Tags that hash to the same counter invalidate each
+    other, which only costs extra misses.
+
+    Processes forked after the store is opened share its mapping, and
+    other processes can open the same file.  Writes are serialized with
+    a lock on the file.
+    """
+    _magic = 'BLINQMEMO1'
+    _header = struct.Struct ('<10sIII')
+    _slot_header = struct.Struct ('<16sddI')
+    _tag_counter = struct.Struct ('<Q')
+
+    def __init__ (self, filename, buckets=4096, ways=4, slot_size=4096,
+                  tag_slots=1024, **kw):
+        super (MmapMemoStore, self).__init__ (**kw)
+        self.filename = filename
+        self.buckets = buckets
+        self.ways = ways
+        self.slot_size = slot_size
+        self.tag_slots = tag_slots
+        self._tags_offset = self._header.size
+        self._slots_offset = self._tags_offset + tag_slots * self._tag_counter.size
+        self._size = self._slots_offset + buckets * ways * slot_size
+        self._lock = threading.Lock ()
+        self._fd = os.open (filename, os.O_RDWR | os.O_CREAT, 0600)
+        self._lock_file ()
+        try:
+            header = self._header.pack (self._magic, buckets, ways, slot_size)
+            os.lseek (self._fd, 0, os.SEEK_SET)
+            if (os.fstat (self._fd).st_size != self._size or
+                os.read (self._fd, len(header)) != header):
+                os.ftruncate (self._fd, 0)
+                os.ftruncate (self._fd, self._size)
+                os.lseek (self._fd, 0, os.SEEK_SET)
+                os.write (self._fd, header)
+            self._map = mmap.mmap (self._fd, self._size)
+        finally:
+            self._unlock_file ()
+
+    def _lock_file (self):
+        # POSIX record locks belong to a process, so forked children
+        # don't share them.  Threads do, so they also take _lock.
+        import fcntl
+        self._lock.acquire ()
+        try:
+            fcntl.lockf (self._fd, fcntl.LOCK_EX)
+        except:
+            self._lock.release ()
+            raise
+
+    def _unlock_file (self):
+        import fcntl
+        try:
+            fcntl.lockf (self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release ()
+
+    def _get_digest (self, key):
+        return hashlib.md5 (blinq.utils.utf8enc (key)).digest ()
+
+    def _get_slots (self, digest):
+        bucket = struct.unpack ('<I', digest[:4])[0] % self.buckets
+        start = self._slots_offset + bucket * self.ways * self.slot_size
+        return range (start, start + self.ways * self.slot_size, self.slot_size)
+
+    def _get_tag_offset (self, tag):
+        digest = hashlib.md5 (blinq.utils.utf8enc (tag)).digest ()
+        index = struct.unpack ('<I', digest[:4])[0] % self.tag_slots
+        return self._tags_offset + index * self._tag_counter.size
+
+    def _get_tag_counter (self, tag):
+        return self._tag_counter.unpack_from (self._map, self._get_tag_offset (tag))[0]
+
+    def _find (self, digest):
+        for offset in self._get_slots (digest):
+            if self._map[offset:offset + 16] == digest:
+                return offset
+        return None
+
+    def load (self, key):
+        digest = self._get_digest (key)
+        self._lock_file ()
+        try:
+            offset = self._find (digest)
+            if offset is None:
+                raise KeyError (key)
+            (digest, expires, used, length) = self._slot_header.unpack_from (self._map, offset)
+            if expires != 0 and expires < time.time ():
+                self._map[offset:offset + 16] = '\0' * 16
+                raise KeyError (key)
+            start = offset + self._slot_header.size
+            (saved, tags, value) = cPickle.loads (self._map[start:start + length])
+            if saved != key:
+                raise KeyError (key)
+            for (tag, counter) in tags:
+                if self._get_tag_counter (tag) != counter:
+                    self._map[offset:offset + 16] = '\0' * 16
+                    raise KeyError (key)
+            self._slot_header.pack_into (self._map, offset, digest, expires,
+                                         time.time (), length)
+            return value
+        finally:
+            self._unlock_file ()
+
+    def save (self, key, value, expires, tags):
+        digest = self._get_digest (key)
+        self._lock_file ()
+        try:
+            tags = [(tag, self._get_tag_counter (tag)) for tag in tags]
+            data = cPickle.dumps ((key, tags, value), cPickle.HIGHEST_PROTOCOL)
+            offset = self._find (digest)
+            if len(data) > self.slot_size - self._slot_header.size:
+                if offset is not None:
+                    self._map[offset:offset + 16] = '\0' * 16
+                return
+            if offset is None:
+                # Take an empty slot if there is one, or else evict the
+                # least recently used slot in the bucket.
+                oldest = None
+                for slot in self._get_slots (digest):
+                    header = self._slot_header.unpack_from (self._map, slot)
+                    if header[0] == '\0' * 16:
+                        oldest = (None, slot)
+                        break
+                    if oldest is None or header[2] < oldest[0]:
+                        oldest = (header[2], slot)
+                offset = oldest[1]
+            self._slot_header.pack_into (self._map, offset, digest, expires or 0,
+                                         time.time (), len(data))
+            start = offset + self._slot_header.size
+            self._map[start:start + len(data)] = data
+        finally:
+            self._unlock_file ()
+
+    def delete (self, key):
+        digest = self._get_digest (key)
+        self._lock_file ()
+        try:
+            offset = self._find (digest)
+            if offset is not None:
+                self._map[offset:offset + 16] = '\0' * 16
+        finally:
+            self._unlock_file ()
+
+    def invalidate (self, tag):
+        offset = self._get_tag_offset (tag)
+        self._lock_file ()
+        try:
+            counter = self._tag_counter.unpack_from (self._map, offset)[0]
+            self._tag_counter.pack_into (self._map, offset, counter + 1)
+        finally:
+            self._unlock_file ()
+
+    def clear (self):
+        self._lock_file ()
+        try:
+            empty = '\0' * self.slot_size
+            for offset in range (self._slots_offset, self._size, self.slot_size):
+                self._map[offset:offset + self.slot_size] = empty
+        finally:
+            self._unlock_file ()
+
+    def close (self):
+        self._map.close ()
+        os.close (self._fd)
+
+
+_sqlite_memo_schema = (
+    'CREATE TABLE IF NOT EXISTS memo '
+    '(key TEXT PRIMARY KEY, expires REAL, used REAL, data BLOB)',
+    'CREATE TABLE IF NOT EXISTS memo_tags (tag TEXT, key TEXT)',
+    'CREATE INDEX IF NOT EXISTS memo_tags_tag ON memo_tags (tag)',
+    'CREATE INDEX IF NOT EXISTS memo_tags_key ON memo_tags (key)',
+    'CREATE INDEX IF NOT EXISTS memo_used ON memo (used)',
+    'CREATE TABLE IF NOT EXISTS memo_count (count INTEGER)',
+    'INSERT INTO memo_count SELECT COUNT(*) FROM memo '
+    'WHERE NOT EXISTS (SELECT * FROM memo_count)',
+    'CREATE TRIGGER IF NOT EXISTS memo_insert AFTER INSERT ON memo '
+    'BEGIN UPDATE memo_count SET count = count + 1; END',
+    'CREATE TRIGGER IF NOT EXISTS memo_delete AFTER DELETE ON memo '
+    'BEGIN UPDATE memo_count SET count = count - 1; '
+    'DELETE FROM memo_tags WHERE key = old.key; END')
+
+
+class SqliteMemoStore (object):
+    """
+    Memo store that keeps values in an SQLite database file
+
+    At most max_entries values are kept, evicting the least recently
+    used.  The number of values is kept up to date by triggers in the
+    database, as are the tags of deleted values.  To avoid a write on
+    every hit, the last use of a value is only updated once it is more
+    than use_resolution seconds old.
+    """
+    def __init__ (self, filename, max_entries=100000, use_resolution=60, **kw):
+        super (SqliteMemoStore, self).__init__ (**kw)
+        self.filename = filename
+        self.max_entries = max_entries
+        self.use_resolution = use_resolution
+        self._db = blinq.utils.SqliteConnection (filename, _sqlite_memo_schema)
+        self._lock = threading.Lock ()
+
+    def _get_conn (self):
+        return self._db.get ()
+
+    def _delete_keys (self, conn, keys):
+        for key in keys:
+            conn.execute ('DELETE FROM memo WHERE key = ?', (key,))
+
+    def load (self, key):
+        key = blinq.utils.utf8dec (key)
+        now = time.time ()
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            row = conn.execute ('SELECT expires, used, data FROM memo WHERE key = ?',
+                                (key,)).fetchone ()
+            if row is None:
+                raise KeyError (key)
+            if row[0] is not None and row[0] < now:
+                self._delete_keys (conn, [key])
+                conn.commit ()
+                raise KeyError (key)
+            if row[1] + self.use_resolution < now:
+                conn.execute ('UPDATE memo SET used = ? WHERE key = ?', (now, key))
+                conn.commit ()
+        finally:
+            self._lock.release ()
+        return cPickle.loads (str (row[2]))
+
+    def save (self, key, value, expires, tags):
+        import sqlite3
+        key = blinq.utils.utf8dec (key)
+        data = sqlite3.Binary (cPickle.dumps (value, cPickle.HIGHEST_PROTOCOL))
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            # Replacing a row wouldn't run the delete trigger
+            conn.execute ('DELETE FROM memo WHERE key = ?', (key,))
+            conn.execute ('INSERT INTO memo VALUES (?, ?, ?, ?)',
+                          (key, expires, time.time (), data))
+            for tag in tags:
+                conn.execute ('INSERT INTO memo_tags VALUES (?, ?)',
+                              (blinq.utils.utf8dec (tag), key))
+            count = conn.execute ('SELECT count FROM memo_count').fetchone ()[0]
+            if count > self.max_entries:
+                rows = conn.execute ('SELECT key FROM memo ORDER BY used LIMIT ?',
+                                     (count - self.max_entries,)).fetchall ()
+                self._delete_keys (conn, [row[0] for row in rows])
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+    def delete (self, key):
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            self._delete_keys (conn, [blinq.utils.utf8dec (key)])
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+    def invalidate (self, tag):
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            tag = blinq.utils.utf8dec (tag)
+            conn.execute ('DELETE FROM memo WHERE key IN '
+                          '(SELECT key FROM memo_tags WHERE tag = ?)', (tag,))
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+    def clear (self):
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            conn.execute ('DELETE FROM memo')
+            conn.execute ('DELETE FROM memo_tags')
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+    def expire (self):
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            conn.execute ('DELETE FROM memo WHERE expires < ?', (time.time (),))
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+
+class MemoCache (object):
+    """
+    Cache of computed values that lasts across requests
+
+    Values are kept in store, which defaults to a MemoryMemoStore, for
+    ttl seconds, or until they are evicted.  A ttl of None keeps values
+    until they are evicted.  Values can be saved with a list of tags, and
+    invalidating a tag discards every value saved with it.
+
+    The cache counts hits, misses, and saves made in this process, which
+    are returned by get_stats.
+    """
+    def __init__ (self, store=None, ttl=300, **kw):
+        super (MemoCache, self).__init__ (**kw)
+        if store is None:
+            store = MemoryMemoStore ()
+        self.store = store
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.invalidations = 0
+
+    def get (self, key, default=None):
+        try:
+            value = self.store.load (key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set (self, key, value, ttl=None, tags=()):
+        """Save a value for ttl seconds, or the cache's default ttl"""
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time () + ttl
+        self.saves += 1
+        self.store.save (key, value, expires, tuple (tags))
+
+    def delete (self, key):
+        self.store.delete (key)
+
+    def invalidate (self, *tags):
+        """Discard every value saved with any of tags"""
+        for tag in tags:
+            self.invalidations += 1
+            self.store.invalidate (tag)
+
+    def clear (self):
+        self.store.clear ()
+
+    def get_or_compute (self, key, func, ttl=None, tags=()):
+        """
+        Get the value for key, or call func to compute it and save it
+        """
+        try:
+            value = self.store.load (key)
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            return value
+        value = func ()
+        self.set (key, value, ttl=ttl, tags=tags)
+        return value
+
+    def memoize (self, ttl=None, tags=()):
+        """
+        Decorator that caches the results of a function by its arguments
+
+        The key is made from the name of the function and the repr of its
+        arguments, so arguments should have a repr that identifies them.
+        """
+        def decorator (func):
+            prefix = '%s.%s:' % (func.__module__, func.__name__)
+            @functools.wraps (func)
+            def wrapper (*args, **kw):
+                key = prefix + repr ((args, sorted (kw.items ())))
+                return self.get_or_compute (key, lambda: func (*args, **kw),
+                                            ttl=ttl, tags=tags)
+            return wrapper
+        return decorator
+
+    def get_stats (self):
+        """Get the hit, miss, save, and invalidation counts as a dictionary"""
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'saves': self.saves,
+                'invalidations': self.invalidations,
+                'hit_rate': total and float (self.hits) / total or 0.0}
+
+    def reset_stats (self):
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.invalidations = 0
+
+
+_cache = None
+
+def get_cache ():
+    """Get the shared in-memory MemoCache for this process"""
+    global _cache
+    if _cache is None:
+        _cache = MemoCache ()
+    return _cache
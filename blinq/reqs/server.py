@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""
+Prefork HTTP server for web responders
+
+The master process imports extensions once, then forks worker processes
+that share the loaded modules and accept connections on one listening
+socket.  Workers speak HTTP/1.1 with keep-alive and are replaced after
+handling max_requests requests.  Sending SIGHUP to the master restarts
+the workers gracefully, and SIGTERM or SIGINT shuts the server down after
+workers finish their current requests.
+"""
+
+import BaseHTTPServer
+import errno
+import optparse
+import os
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+import urllib
+
+import blinq.config
+import blinq.ext
+import blinq.reqs.form
+import blinq.reqs.timing
+import blinq.reqs.web
+
+
+class _BodyReader (object):
+    """File wrapper that reads at most length bytes of a request body"""
+    def __init__ (self, fp, length):
+        self._fp = fp
+        self.remaining = length
+
+    def read (self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ''
+        data = self._fp.read (size)
+        self.remaining -= len(data)
+        return data
+
+    def readline (self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ''
+        data = self._fp.readline (size)
+        self.remaining -= len(data)
+        return data
+
+    def drain (self):
+        while self.remaining > 0:
+            if self.read (min (self.remaining, 65536)) == '':
+                break
+
+
+class _ResponseWriter (object):
+    """Output file for a WebResponse that writes HTTP to a handler"""
+    def __init__ (self, handler):
+        self._handler = handler
+        self._has_body = False
+        self._chunked = False
+        self.started = False
+
+    def start (self, status, headers):
+        handler = self._handler
+        (code, message) = status.split (' ', 1)
+        self.started = True
+        self._has_body = handler.command != 'HEAD' and int (code) not in (204, 304)
+        handler.send_response (int (code), message)
+        length = False
+        for key, val in headers:
+            if val is None:
+                continue
+            if key.lower () == 'content-length':
+                length = True
+            handler.send_header (key, str(val).strip())
+        server = handler.server
+        if server.stopping or server.requests >= server.max_requests:
+            handler.close_connection = 1
+        if self._has_body and not length:
+            if handler.request_version == 'HTTP/1.1':
+                self._chunked = True
+                handler.send_header ('Transfer-Encoding', 'chunked')
+            else:
+                handler.close_connection = 1
+        if handler.close_connection:
+            handler.send_header ('Connection', 'close')
+        handler.end_headers ()
+
+    def write (self, data):
+        if not self._has_body or data == '':
+            return
+        if self._chunked:
+            self._handler.wfile.write ('%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self._handler.wfile.write (data)
+
+    def flush (self):
+        self._handler.wfile.flush ()
+
+    def finish (self):
+        if self._chunked:
+            self._handler.wfile.write ('0\r\n\r\n')
+
+
+class WebRequestHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP request handler that translates requests for a web responder"""
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    _handled = 0
+    _idle = False
+
+    def handle_one_request (self):
+        # Between requests on a kept-alive connection, only wait for the
+        # next one for keepalive_timeout, so idle clients don't hold the
+        # worker.  The request line arriving restores the I/O timeout.
+        self._idle = self._handled > 0
+        if self._idle:
+            self.connection.settimeout (self.server.keepalive_timeout)
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request (self)
+        self._handled += 1
+        if self.server.stopping or self.server.requests >= self.server.max_requests:
+            self.close_connection = 1
+
+    def parse_request (self):
+        if self._idle:
+            self._idle = False
+            self.connection.settimeout (self.server.timeout)
+        return BaseHTTPServer.BaseHTTPRequestHandler.parse_request (self)
+
+    def _get_environ (self, body):
+        if '?' in self.path:
+            (path, query) = self.path.split ('?', 1)
+        else:
+            (path, query) = (self.path, '')
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote (path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str (self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'CONTENT_LENGTH': str (body.remaining),
+            }
+        for key, val in self.headers.items ():
+            key = key.upper ().replace ('-', '_')
+            if key == 'CONTENT_TYPE':
+                environ[key] = val
+            elif key != 'CONTENT_LENGTH':
+                environ['HTTP_' + key] = val
+        return environ
+
+    def _read_chunked (self):
+        """
+        Decode a chunked request body into a temporary file, returning a
+        _BodyReader for it, or None if an error response was sent
+        """
+        max_size = blinq.reqs.form.FormParser.max_total_size
+        spool = tempfile.SpooledTemporaryFile (max_size=blinq.reqs.form.FormParser.spool_size)
+        total = 0
+        try:
+            while True:
+                line = self.rfile.readline (65537)
+                size = int (line.split (';', 1)[0].strip (), 16)
+                if size < 0:
+                    raise ValueError (line)
+                if size == 0:
+                    while self.rfile.readline (65537) not in ('\r\n', '\n', ''):
+                        pass
+                    break
+                total += size
+                if total > max_size:
+                    self.close_connection = 1
+                    self.send_error (413)
+                    return None
+                while size > 0:
+                    data = self.rfile.read (min (size, 65536))
+                    if data == '':
+                        raise ValueError ('Truncated chunk')
+                    spool.write (data)
+                    size -= len(data)
+                if self.rfile.readline (65537) not in ('\r\n', '\n'):
+                    raise ValueError ('Missing chunk terminator')
+        except ValueError:
+            self.close_connection = 1
+            self.send_error (400)
+            return None
+        spool.seek (0)
+        return _BodyReader (spool, total)
+
+    def _respond (self):
+        self.server.requests += 1
+        if self.headers.get ('Transfer-Encoding', 'identity').lower () != 'identity':
+            if self.headers['Transfer-Encoding'].lower () != 'chunked':
+                self.close_connection = 1
+                self.send_error (501)
+                return
+            body = self._read_chunked ()
+            if body is None:
+                return
+        else:
+            try:
+                length = int (self.headers.get ('Content-Length', 0))
+            except ValueError:
+                self.close_connection = 1
+                self.send_error (400)
+                return
+            body = _BodyReader (self.rfile, length)
+        request = blinq.reqs.web.WebRequest (environ=self._get_environ (body),
+                                             stdin=body)
+        writer = _ResponseWriter (self)
+        try:
+            response = blinq.reqs.timing.respond (self.server.responder, request)
+            response.output (fp=writer, header_func=writer.start)
+        except blinq.reqs.form.FormError, err:
+            if not self._respond_error (request, writer, err.http_status, err.desc):
+                return
+        except Exception:
+            self.log_error ('Error responding to %s\n%s', self.path, traceback.format_exc ())
+            if not self._respond_error (request, writer, 500, 'Internal server error'):
+                return
+        writer.finish ()
+        body.drain ()
+
+    def _respond_error (self, request, writer, http_status, desc):
+        """
+        Send an error response if no headers have been sent yet, returning
+        False if the response was already started and has to be abandoned
+        """
+        # The body may not have been read, so it can't be kept alive.
+        self.close_connection = 1
+        if writer.started:
+            return False
+        response = blinq.reqs.web.get_error_response (request, http_status, desc)
+        response.output (fp=writer, header_func=writer.start)
+        return True
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message (self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message (self, format, *args)
+
+    def log_error (self, format, *args):
+        if self._idle:
+            # A kept-alive connection timing out between requests is normal
+            return
+        BaseHTTPServer.BaseHTTPRequestHandler.log_message (self, format, *args)
+
+
+class PreforkServer (object):
+    """
+    HTTP server that forks worker processes to run a web responder
+
+    Workers are forked with the modules already loaded in this process,
+    so call import_extensions before serve_forever.  Each worker serves
+    one connection at a time.  Socket reads and writes time out after
+    timeout seconds, but a kept-alive connection is closed if no new
+    request starts within keepalive_timeout seconds, so idle clients
+    don't tie up workers.
+    """
+    handler_class = WebRequestHandler
+
+    def __init__ (self, responder, address=('', 8000), workers=4,
+                  max_requests=1000, timeout=15, keepalive_timeout=2,
+                  verbose=False, **kw):
+        super (PreforkServer, self).__init__ (**kw)
+        self.responder = responder
+        self.address = address
+        self.workers = workers
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.verbose = verbose
+        self.socket = None
+        self.server_name = None
+        self.server_port = None
+        self.stopping = False
+        self.requests = 0
+        self._pids = set ()
+        self._restart = False
+
+    def serve_forever (self):
+        self.socket = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind (self.address)
+        self.socket.listen (128)
+        (host, self.server_port) = self.socket.getsockname ()[:2]
+        self.server_name = socket.getfqdn (host)
+
+        signal.signal (signal.SIGHUP, self._on_sighup)
+        signal.signal (signal.SIGTERM, self._on_sigterm)
+        signal.signal (signal.SIGINT, self._on_sigterm)
+        for i in range (self.workers):
+            self._spawn ()
+
+        while not self.stopping:
+            if self._restart:
+                self._restart = False
+                blinq.config.reload ()
+                old = self._pids
+                self._pids = set ()
+                for pid in old:
+                    self._kill (pid)
+                for i in range (self.workers):
+                    self._spawn ()
+            try:
+                (pid, status) = os.wait ()
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self._pids:
+                self._pids.remove (pid)
+                if not self.stopping:
+                    self._spawn ()
+
+        for pid in self._pids:
+            self._kill (pid)
+        while True:
+            try:
+                os.wait ()
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                break
+        self.socket.close ()
+
+    def _on_sighup (self, signum, frame):
+        self._restart = True
+
+    def _on_sigterm (self, signum, frame):
+        self.stopping = True
+
+    def _kill (self, pid):
+        try:
+            os.kill (pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _spawn (self):
+        pid = os.fork ()
+        if pid != 0:
+            self._pids.add (pid)
+            return
+        code = 0
+        try:
+            try:
+                self._work ()
+            except:
+                traceback.print_exc ()
+                code = 1
+        finally:
+            os._exit (code)
+
+    def _work (self):
+        signal.signal (signal.SIGHUP, signal.SIG_IGN)
+        signal.signal (signal.SIGINT, signal.SIG_IGN)
+        signal.signal (signal.SIGTERM, self._on_sigterm)
+        self._pids = set ()
+        self.requests = 0
+        while not self.stopping and self.requests < self.max_requests:
+            try:
+                (conn, addr) = self.socket.accept ()
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            conn.settimeout (self.timeout)
+            try:
+                self.handler_class (conn, addr, self)
+            except (socket.error, socket.timeout):
+                pass
+            except Exception:
+                traceback.print_exc ()
+            finally:
+                try:
+                    conn.close ()
+                except socket.error:
+                    pass
+
+
+def main (argv=None):
+    """Run a PreforkServer from the command line"""
+    parser = optparse.OptionParser (
+        usage='%prog [options] MODULE:RESPONDER')
+    parser.add_option ('-b', '--bind', dest='bind', default='127.0.0.1:8000',
+                       help='address and port to listen on')
+    parser.add_option ('-w', '--workers', dest='workers', type='int', default=4,
+                       help='number of worker processes')
+    parser.add_option ('-m', '--max-requests', dest='max_requests', type='int',
+                       default=1000, help='requests before a worker is replaced')
+    parser.add_option ('-k', '--keepalive-timeout', dest='keepalive_timeout',
+                       type='float', default=2,
+                       help='seconds to wait for another request on a connection')
+    parser.add_option ('-p', '--plugins', dest='plugins', default=None,
+                       help='package to import extensions from')
+    parser.add_option ('-d', '--domain', dest='domain', default='web',
+                       help='extension domain to import from each plugin')
+    parser.add_option ('-c', '--config', dest='config', default=None,
+                       help='config file to read')
+    parser.add_option ('-v', '--verbose', dest='verbose', action='store_true',
+                       default=False, help='log each request')
+    (options, args) = parser.parse_args (argv)
+    if len(args) != 1 or ':' not in args[0]:
+        parser.error ('You must specify a responder as MODULE:RESPONDER.')
+
+    if options.config is not None:
+        blinq.config.init (options.config)
+    if options.plugins is not None:
+        __import__ (options.plugins)
+        blinq.ext.import_extensions (sys.modules[options.plugins], options.domain)
+    (modname, attr) = args[0].split (':', 1)
+    __import__ (modname)
+    responder = getattr (sys.modules[modname], attr)
+
+    (host, port) = options.bind.rsplit (':', 1)
+    server = PreforkServer (responder, address=(host, int (port)),
+                            workers=options.workers,
+                            max_requests=options.max_requests,
+                            keepalive_timeout=options.keepalive_timeout,
+                            verbose=options.verbose)
+    server.serve_forever ()
+
+
+if __name__ == '__main__':
+    main ()
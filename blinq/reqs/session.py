@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""Server-side sessions with signed session cookies"""
+
+import collections
+import hashlib
+import hmac
+import json
+import os
+import os.path
+import threading
+import time
+
+import blinq.config
+import blinq.utils
+
+
+class MemorySessionStore (object):
+    """
+    Session store that keeps sessions in memory in this process
+
+    At most max_entries sessions are kept, evicting the least recently
+    used.  Sessions unused for max_age seconds are discarded.
+    """
+    def __init__ (self, max_entries=10000, max_age=86400, **kw):
+        super (MemorySessionStore, self).__init__ (**kw)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._sessions = collections.OrderedDict ()
+        self._lock = threading.Lock ()
+
+    def load (self, sid):
+        self._lock.acquire ()
+        try:
+            entry = self._sessions.pop (sid, None)
+            if entry is None or entry[0] + self.max_age < time.time ():
+                return None
+            self._sessions[sid] = entry
+            return json.loads (entry[1])
+        finally:
+            self._lock.release ()
+
+    def save (self, sid, data):
+        entry = (time.time (), json.dumps (data))
+        self._lock.acquire ()
+        try:
+            self._sessions.pop (sid, None)
+            self._sessions[sid] = entry
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem (last=False)
+        finally:
+            self._lock.release ()
+
+    def delete (self, sid):
+        self._lock.acquire ()
+        try:
+            self._sessions.pop (sid, None)
+        finally:
+            self._lock.release ()
+
+
+class SqliteSessionStore (object):
+    """
+    Session store that keeps sessions in an SQLite database file
+
+    Sessions not saved for max_age seconds are ignored, and are removed
+    from the database by calling expire.
+    """
+    def __init__ (self, filename, max_age=86400, **kw):
+        super (SqliteSessionStore, self).__init__ (**kw)
+        self.filename = filename
+        self.max_age = max_age
+        self._db = blinq.utils.SqliteConnection (filename, (
+            'CREATE TABLE IF NOT EXISTS sessions '
+            '(sid TEXT PRIMARY KEY, mtime REAL, data TEXT)',))
+        self._lock = threading.Lock ()
+
+    def _get_conn (self):
+        return self._db.get ()
+
+    def load (self, sid):
+        self._lock.acquire ()
+        try:
+            row = self._get_conn ().execute (
+                'SELECT data FROM sessions WHERE sid = ? AND mtime >= ?',
+                (sid, time.time () - self.max_age)).fetchone ()
+        finally:
+            self._lock.release ()
+        if row is None:
+            return None
+        return json.loads (row[0])
+
+    def save (self, sid, data):
+        data = json.dumps (data)
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            conn.execute ('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                          (sid, time.time (), data))
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+    def delete (self, sid):
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            conn.execute ('DELETE FROM sessions WHERE sid = ?', (sid,))
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+    def expire (self):
+        self._lock.acquire ()
+        try:
+            conn = self._get_conn ()
+            conn.execute ('DELETE FROM sessions WHERE mtime < ?',
+                          (time.time () - self.max_age,))
+            conn.commit ()
+        finally:
+            self._lock.release ()
+
+
+class FileSessionStore (object):
+    """
+    Session store that keeps each session in a file in a directory
+
+    Sessions whose files have not been written for max_age seconds are
+    ignored, and are removed by calling expire.
+    """
+    def __init__ (self, dirname, max_age=86400, **kw):
+        super (FileSessionStore, self).__init__ (**kw)
+        self.dirname = dirname
+        self.max_age = max_age
+        if not os.path.exists (self.dirname):
+            os.makedirs (self.dirname)
+
+    def _get_filename (self, sid):
+        return os.path.join (self.dirname, 'session-' + sid)
+
+    def load (self, sid):
+        filename = self._get_filename (sid)
+        try:
+            if os.stat (filename).st_mtime + self.max_age < time.time ():
+                return None
+            fp = open (filename)
+            try:
+                return json.load (fp)
+            finally:
+                fp.close ()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save (self, sid, data):
+        filename = self._get_filename (sid)
+        tmpname = '%s.%i' % (filename, os.getpid ())
+        fp = open (tmpname, 'w')
+        try:
+            json.dump (data, fp)
+        finally:
+            fp.close ()
+        os.rename (tmpname, filename)
+
+    def delete (self, sid):
+        try:
+            os.remove (self._get_filename (sid))
+        except OSError:
+            pass
+
+    def expire (self):
+        cutoff = time.time () - self.max_age
+        for filename in os.listdir (self.dirname):
+            if not filename.startswith ('session-'):
+                continue
+            filename = os.path.join (self.dirname, filename)
+            try:
+                if os.stat (filename).st_mtime < cutoff:
+                    os.remove (filename)
+            except OSError:
+                pass
+
+
+class Session (object):
+    """
+    Data for one session, loaded from the store on first access
+
+    A Session acts like a dictionary.  Nothing is read from the store
+    until a value is accessed, and nothing is written back unless a value
+    is changed, so requests that don't use the session do no I/O.
+    """
+    def __init__ (self, manager, sid):
+        self._manager = manager
+        self.sid = sid
+        self._data = None
+        self.modified = False
+
+    def _load (self):
+        if self._data is None:
+            if self.sid is not None:
+                self._data = self._manager.store.load (self.sid)
+            if self._data is None:
+                self.sid = None
+                self._data = {}
+        return self._data
+
+    def __getitem__ (self, key):
+        return self._load ()[key]
+
+    def __setitem__ (self, key, value):
+        self._load ()[key] = value
+        self.modified = True
+
+    def __delitem__ (self, key):
+        del self._load ()[key]
+        self.modified = True
+
+    def __contains__ (self, key):
+        return key in self._load ()
+
+    def get (self, key, default=None):
+        return self._load ().get (key, default)
+
+    def keys (self):
+        return self._load ().keys ()
+
+    def clear (self):
+        self._load ().clear ()
+        self.modified = True
+
+
+class SessionManager (object):
+    """
+    Manages sessions identified by signed cookies
+
+    The session id in the cookie is signed with an HMAC using secret, or
+    the web_session_secret config option.  Without either, a random secret
+    is made, and sessions only work within this process.
+    """
+    def __init__ (self, store, secret=None, cookie_name='blinq_session', **kw):
+        super (SessionManager, self).__init__ (**kw)
+        self.store = store
+        self.cookie_name = cookie_name
+        if secret is None:
+            secret = blinq.config.web_session_secret
+        if secret is None:
+            secret = os.urandom (32)
+        self._secret = secret
+
+    def _sign (self, sid):
+        return hmac.new (self._secret, sid, hashlib.sha256).hexdigest ()
+
+    def get_session (self, request):
+        """Get the session for a request, without loading its data"""
+        sid = None
+        morsel = request.cookies.get (self.cookie_name)
+        if morsel is not None and '.' in morsel.value:
+            (value, sig) = morsel.value.split ('.', 1)
+            if hmac.compare_digest (self._sign (value), sig):
+                sid = value
+        return Session (self, sid)
+
+    def save_session (self, session, response):
+        """
+        Write a session back to its store if it has been modified, setting
+        the session cookie on response if the session is new
+        """
+        if not session.modified:
+            return
+        if len(session._data) == 0:
+            if session.sid is not None:
+                self.store.delete (session.sid)
+            return
+        if session.sid is None:
+            session.sid = os.urandom (16).encode ('hex')
+            response.set_cookie (self.cookie_name,
+                                 session.sid + '.' + self._sign (session.sid),
+                                 httponly=True)
+        self.store.save (session.sid, session._data)
+        session.modified = False
+
+
+class SessionResponder (object):
+    """
+    Wraps a web responder to give each request a session
+
+    Responders get the session with request.get_data('session').
+    """
+    def __init__ (self, responder, manager, **kw):
+        super (SessionResponder, self).__init__ (**kw)
+        self.responder = responder
+        self.manager = manager
+
+    def respond (self, request):
+        session = self.manager.get_session (request)
+        request.set_data ('session', session)
+        response = self.responder.respond (request)
+        self.manager.save_session (session, response)
+        return response
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# Blinq is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blinq is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blinq; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+"""
+Per-phase request timing and sampled profiling
+
+Timing is off unless enable is called or the BLINQ_TIMING environment
+variable is set.  When it is on, each request handled through respond is
+timed in these phases, and the times are collected into a latency
+histogram for each responder:
+
+  parse     parsing the request path, query, body, and cookies
+  dispatch  finding the responder for a request
+  respond   running the responder, not counting parse time
+  render    generating the payload, not counting flush time
+  flush     writing output to the client
+
+Functions added with add_hook are also called with the responder name,
+the phase, and the time in seconds for every measurement.
+
+If the profile_rate config option or the BLINQ_PROFILE environment
+variable is set to a fraction, that fraction of requests is also run
+under cProfile.  The profile data for each responder is accumulated and
+written to a file named for the responder in the profile_dir directory.
+"""
+
+import json
+import os
+import os.path
+import random
+import threading
+import time
+
+import blinq.config
+import blinq.reqs
+
+
+enabled = bool (os.environ.get ('BLINQ_TIMING'))
+
+PHASES = ('parse', 'dispatch', 'respond', 'render', 'flush')
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_stats = {}
+_hooks = []
+_lock = threading.Lock ()
+_profilers = {}
+_profile_lock = threading.Lock ()
+
+
+def enable ():
+    global enabled
+    enabled = True
+
+def disable ():
+    global enabled
+    enabled = False
+
+def add_hook (func):
+    """Call func with the responder name, phase, and seconds for each timing"""
+    _hooks.append (func)
+
+def reset ():
+    _lock.acquire ()
+    try:
+        _stats.clear ()
+    finally:
+        _lock.release ()
+
+def start ():
+    """Get a start time if timing is enabled, or None"""
+    if enabled:
+        return time.time ()
+    return None
+
+def elapsed (start):
+    """Get the seconds since a time returned by start, or 0 if it was None"""
+    if start is None:
+        return 0.0
+    return time.time () - start
+
+def record (name, phase, secs):
+    """Record the time for one phase of a request to a responder"""
+    msecs = secs * 1000
+    bucket = len(BUCKETS)
+    for i in range (len(BUCKETS)):
+        if msecs <= BUCKETS[i]:
+            bucket = i
+            break
+    _lock.acquire ()
+    try:
+        stat = _stats.get ((name, phase))
+        if stat is None:
+            stat = {'count': 0, 'total': 0.0, 'max': 0.0,
+                    'buckets': [0] * (len(BUCKETS) + 1)}
+            _stats[(name, phase)] = stat
+        stat['count'] += 1
+        stat['total'] += msecs
+        stat['max'] = max (stat['max'], msecs)
+        stat['buckets'][bucket] += 1
+    finally:
+        _lock.release ()
+    for hook in _hooks:
+        hook (name, phase, secs)
+
+def get_name (responder):
+    """Get the name of a responder, looking through wrapping responders"""
+    while hasattr (responder, 'responder'):
+        responder = responder.responder
+    return getattr (responder, '__name__', responder.__class__.__name__)
+
+def _get_profile_rate ():
+    rate = os.environ.get ('BLINQ_PROFILE')
+    if rate is None:
+        rate = blinq.config.profile_rate
+    try:
+        return float (rate or 0)
+    except ValueError:
+        return 0.0
+
+
+class ResponseTiming (object):
+    """Timing state attached to a response while it is output"""
+    __slots__ = ('name', 'flush', 'profiler')
+
+    def __init__ (self, name, profiler):
+        self.name = name
+        self.flush = 0.0
+        self.profiler = profiler
+
+    def output (self, response, fp, header_func):
+        begin = time.time ()
+        if self.profiler is not None:
+            self.profiler.enable ()
+        try:
+            response._output (fp, header_func)
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable ()
+                _dump_profile (self.name, self.profiler)
+            record (self.name, 'render', time.time () - begin - self.flush)
+            record (self.name, 'flush', self.flush)
+
+
+def _dump_profile (name, profiler):
+    try:
+        profiler.dump_stats (os.path.join (blinq.config.profile_dir, name + '.prof'))
+    finally:
+        _profile_lock.release ()
+
+def respond (responder, request):
+    """
+    Get a response from a responder, timing it if timing is enabled
+
+    With timing enabled, the response will time its output as well.  If
+    responder has a dispatch method, as WebResponder does, it is called to
+    get the responder that actually handles the request, which is then
+    timed under its own name.
+    """
+    if not enabled:
+        return responder.respond (request)
+    dispatch = getattr (responder, 'dispatch', None)
+    if dispatch is not None:
+        responder = dispatch (request)
+    name = get_name (responder)
+    profiler = None
+    rate = _get_profile_rate ()
+    if rate > 0 and random.random () < rate and _profile_lock.acquire (False):
+        import cProfile
+        profiler = _profilers.get (name)
+        if profiler is None:
+            profiler = _profilers[name] = cProfile.Profile ()
+    parse = getattr (request, '_parse_time', 0.0)
+    begin = time.time ()
+    if profiler is not None:
+        profiler.enable ()
+    try:
+        response = responder.respond (request)
+    except:
+        if profiler is not None:
+            profiler.disable ()
+            _profile_lock.release ()
+        raise
+    if profiler is not None:
+        profiler.disable ()
+    secs = time.time () - begin
+    # Only the parsing done while responding is part of secs.  Any done
+    # earlier, such as for the path in dispatch, is still parse time.
+    total = getattr (request, '_parse_time', 0.0)
+    record (name, 'parse', total)
+    record (name, 'respond', secs - (total - parse))
+    if hasattr (response, '_timing'):
+        response._timing = ResponseTiming (name, profiler)
+    elif profiler is not None:
+        _dump_profile (name, profiler)
+    return response
+
+def get_stats ():
+    """
+    Get the collected timings as a dictionary mapping responder names
+    to dictionaries mapping phases to their statistics
+    """
+    stats = {}
+    _lock.acquire ()
+    try:
+        for (name, phase), stat in _stats.items ():
+            stats.setdefault (name, {})[phase] = {
+                'count': stat['count'], 'total': stat['total'],
+                'max': stat['max'], 'buckets': list (stat['buckets'])}
+    finally:
+        _lock.release ()
+    return stats
+
+def dump (filename):
+    """Write the collected timings to a file as JSON"""
+    fp = open (filename, 'w')
+    try:
+        json.dump ({'buckets': BUCKETS, 'stats': get_stats ()}, fp, indent=2)
+    finally:
+        fp.close ()
+
+def _percentile (stat, fraction):
+    target = stat['count'] * fraction
+    seen = 0
+    for i in range (len(stat['buckets'])):
+        seen += stat['buckets'][i]
+        if seen >= target:
+            if i < len(BUCKETS):
+                return min (BUCKETS[i], stat['max'])
+            return stat['max']
+    return stat['max']
+
+def format_report ():
+    """Get a text report of the collected timings, in milliseconds"""
+    lines = ['%-30s %-9s %8s %9s %9s %9s %9s' %
+             ('responder', 'phase', 'count', 'mean', 'p50<=', 'p95<=', 'max')]
+    stats = get_stats ()
+    for name in sorted (stats.keys ()):
+        for phase in PHASES:
+            stat = stats[name].get (phase)
+            if stat is None or stat['count'] == 0:
+                continue
+            lines.append ('%-30s %-9s %8i %9.2f %9.2f %9.2f %9.2f' %
+                          (name, phase, stat['count'],
+                           stat['total'] / stat['count'],
+                           _percentile (stat, 0.5), _percentile (stat, 0.95),
+                           stat['max']))
+    return '\n'.join (lines) + '\n'
+
+
+class TimingPayload (blinq.reqs.TextPayload):
+    """Text payload showing the collected timings"""
+    def output (self, res):
+        res.write (format_report ())
@@ -17,11 +17,25 @@
 #
 
 import cgi
+import collections
 import Cookie
+import email.utils
+import httplib
+import itertools
+import json
+import mmap
 import os
+import Queue
+import re
 import sys
+import threading
+import time
+import zlib
 
+import blinq.ext
 import blinq.reqs
+import blinq.reqs.form
+import blinq.reqs.timing
 import blinq.utils
 
 
@@ -31,13 +45,36 @@ class WebException (Exception):
         self.desc = desc
 
 
+_cookie_scope = (None, None, None)
+
+def get_cookie_scope ():
+    """
+    Get the domain and path for cookies from the web_root_url option
+
+    The result is computed once and reused for as long as the option
+    keeps the same value.
+    """
+    global _cookie_scope
+    url = blinq.config.web_root_url
+    if _cookie_scope[0] != url:
+        nohttp = url[url.find('://') + 3:]
+        _cookie_scope = (url, nohttp[:nohttp.find('/')], nohttp[nohttp.find('/'):])
+    return _cookie_scope[1:]
+
+
 class WebRequest (blinq.reqs.Request):
+    __slots__ = ('http', 'path_info', 'query_string', 'stdin', 'form_parser',
+                 '_http_cookie', '_path', '_query', '_post_data', '_cookies',
+                 '_parse_time')
+    _parse_counts = {'path': 0, 'query': 0, 'post_data': 0, 'cookies': 0}
+
     def __init__ (self, **kw):
         self.http = kw.pop ('http', True)
         self.path_info = kw.pop ('path_info', None)
         self.query_string = kw.pop ('query_string', None)
         self.stdin = kw.pop ('stdin', sys.stdin)
-        cookies = kw.pop('http_cookie', None)
+        self.form_parser = kw.pop ('form_parser', None)
+        self._http_cookie = kw.pop('http_cookie', None)
 
         super (WebRequest, self).__init__(**kw)
 
@@ -45,41 +82,146 @@ class WebRequest (blinq.reqs.Request):
             self.path_info = self.getenv ('PATH_INFO')
         if self.query_string is None:
             self.query_string = self.getenv ('QUERY_STRING')
-        if cookies is None:
-            cookies = self.getenv('HTTP_COOKIE') or ''
-
-        self.path = []
-        if self.path_info is not None:
-            path = blinq.utils.utf8dec (self.path_info).split ('/')
-            for part in path:
-                if part != '':
-                    self.path.append (part)
-
-        self.post_data = {}
-        if self.getenv('REQUEST_METHOD') == 'POST':
-            environ = self.environ.copy()
-            environ.pop('QUERY_STRING')
-            data = cgi.parse(fp=self.stdin, environ=environ)
-            for key in data.keys():
-                self.post_data[key] = blinq.utils.utf8dec(data[key][0])
-
-        self.query = {}
-        if self.query_string is not None:
-            query = cgi.parse_qs (self.query_string, True)
-            for key in query.keys():
-                self.query[key] = blinq.utils.utf8dec (query[key][0])
-
-        self.cookies = Cookie.SimpleCookie ()
-        self.cookies.load (cookies)
+        if self._http_cookie is None:
+            self._http_cookie = self.getenv('HTTP_COOKIE') or ''
+
+        self._path = None
+        self._query = None
+        self._post_data = None
+        self._cookies = None
+        self._parse_time = 0.0
+
+    @classmethod
+    def get_parse_counts (cls):
+        """
+        Get how many times each lazily parsed attribute has been parsed
+
+        This returns a dictionary mapping the names 'path', 'query',
+        'post_data', and 'cookies' to the number of times that attribute
+        was actually computed, across all requests in this process.
+        """
+        return cls._parse_counts.copy()
+
+    @classmethod
+    def reset_parse_counts (cls):
+        for key in cls._parse_counts:
+            cls._parse_counts[key] = 0
+
+    def _get_path (self):
+        if self._path is None:
+            WebRequest._parse_counts['path'] += 1
+            start = blinq.reqs.timing.start ()
+            self._path = []
+            if self.path_info is not None:
+                path = blinq.utils.utf8dec (self.path_info).split ('/')
+                for part in path:
+                    if part != '':
+                        self._path.append (part)
+            self._parse_time += blinq.reqs.timing.elapsed (start)
+        return self._path
+    def _set_path (self, path):
+        self._path = path
+    path = property (_get_path, _set_path)
+
+    def _get_query (self):
+        if self._query is None:
+            WebRequest._parse_counts['query'] += 1
+            start = blinq.reqs.timing.start ()
+            self._query = {}
+            if self.query_string is not None:
+                query = cgi.parse_qs (self.query_string, True)
+                for key in query.keys():
+                    self._query[key] = query[key][0]
+                self._query = blinq.utils.utf8dec_dict (self._query)
+            self._parse_time += blinq.reqs.timing.elapsed (start)
+        return self._query
+    def _set_query (self, query):
+        self._query = query
+    query = property (_get_query, _set_query)
+
+    def _get_post_data (self):
+        if self._post_data is None:
+            WebRequest._parse_counts['post_data'] += 1
+            start = blinq.reqs.timing.start ()
+            if self.getenv('REQUEST_METHOD') == 'POST':
+                parser = self.form_parser
+                if parser is None:
+                    parser = blinq.reqs.form.FormParser ()
+                self._post_data = parser.parse (self.stdin, self.environ)
+            else:
+                self._post_data = blinq.reqs.form.FormData ()
+            self._parse_time += blinq.reqs.timing.elapsed (start)
+        return self._post_data
+    def _set_post_data (self, post_data):
+        self._post_data = post_data
+    post_data = property (_get_post_data, _set_post_data)
+
+    def _get_cookies (self):
+        if self._cookies is None:
+            WebRequest._parse_counts['cookies'] += 1
+            start = blinq.reqs.timing.start ()
+            self._cookies = Cookie.SimpleCookie ()
+            self._cookies.load (self._http_cookie)
+            self._parse_time += blinq.reqs.timing.elapsed (start)
+        return self._cookies
+    def _set_cookies (self, cookies):
+        self._cookies = cookies
+    cookies = property (_get_cookies, _set_cookies)
 
 
 class WebResponse (blinq.reqs.Response):
+    """
+    Response for web requests
+
+    Output is collected in a buffer of up to buffer_size bytes.  If the
+    whole payload fits in the buffer, the headers are sent with a
+    Content-Length.  Otherwise, or if flush is called explicitly, the
+    headers are sent early and the payload is streamed.
+
+    If compress is True and the client accepts it, payloads with one of
+    the content types in compress_types are compressed with gzip or
+    deflate at compress_level.  Fully buffered payloads smaller than
+    compress_min_size bytes are sent uncompressed.
+
+    Payloads that know their length up front, such as FilePayload, can
+    call set_content_length before writing, which sends Content-Length
+    even when the payload is streamed, and turns off compression.
+    """
+    buffer_size = 64 * 1024
+    compress = True
+    compress_level = 6
+    compress_min_size = 1024
+    compress_types = ('text/html', 'application/json', 'text/plain')
+
+    __slots__ = ('http_content_disposition', 'http_content_range', 'http_accept_ranges',
+                 'http_etag', 'http_last_modified', '_http_status',
+                 '_content_length', '_location', '_cookies', '_fp', '_header_func',
+                 '_headers_sent', '_buffer', '_buffer_len', '_buffer_size',
+                 '_encoding', '_content_encoding', '_compressor', '_vary',
+                 '_timing')
+
     def __init__ (self, request, **kw):
+        self._buffer_size = kw.pop ('buffer_size', self.buffer_size)
         super (WebResponse, self).__init__ (request, **kw)
         self.http_content_disposition = None
+        self.http_content_range = None
+        self.http_accept_ranges = None
+        self.http_etag = None
+        self.http_last_modified = None
         self._http_status = None
+        self._content_length = None
         self._location = None
         self._cookies = []
+        self._fp = None
+        self._header_func = None
+        self._headers_sent = False
+        self._buffer = []
+        self._buffer_len = 0
+        self._encoding = None
+        self._content_encoding = None
+        self._compressor = None
+        self._vary = False
+        self._timing = None
 
     def _get_http_status (self):
         if self._http_status is not None:
@@ -93,7 +235,7 @@ class WebResponse (blinq.reqs.Response):
     http_status = property (_get_http_status, _set_http_status)
 
     def _get_return_code (self):
-        if self.http_status in (None, 200, 301):
+        if self.http_status in (None, 200, 206, 301, 304):
             return 0
         else:
             return self.http_status
@@ -106,8 +248,14 @@ class WebResponse (blinq.reqs.Response):
         self._location = location
         self.payload = None
 
-    def set_cookie (self, cookie, value):
-        self._cookies.append ((cookie, value))
+    def set_cookie (self, cookie, value, **attrs):
+        """
+        Set a cookie for the site's domain and path
+
+        Additional cookie attributes, such as max_age or httponly, can be
+        passed as keyword arguments, with underscores for dashes.
+        """
+        self._cookies.append ((cookie, value, attrs))
 
     def get_response (self):
         status = '200 OK'
@@ -116,42 +264,115 @@ class WebResponse (blinq.reqs.Response):
             status = '404 Not found'
         elif self.http_status == 500:
             status = '500 Internal server error'
+        elif self.http_status == 206:
+            status = '206 Partial content'
+        elif self.http_status == 416:
+            status = '416 Requested range not satisfiable'
+        elif self.http_status not in (None, 200, 301, 304):
+            status = '%i %s' % (self.http_status,
+                                httplib.responses.get (self.http_status, 'Error'))
         if self.http_status == 301:
             status = '301 Moved permanently'
             headers.append(('Location', self._location or blinq.config.web_root_url))
+        elif self.http_status == 304:
+            status = '304 Not modified'
         else:
             headers.append(('Content-type', self.content_type))
             if self.http_content_disposition is not None:
                 headers.append(('Content-disposition', self.http_content_disposition))
-        for cookie, value in self._cookies:
+            if self.http_content_range is not None:
+                headers.append(('Content-Range', self.http_content_range))
+            if self.http_accept_ranges is not None:
+                headers.append(('Accept-Ranges', self.http_accept_ranges))
+        if self.http_etag is not None:
+            etag = self.http_etag
+            if self._encoding is not None and etag.endswith ('"'):
+                # Compressed and uncompressed bodies need different tags.
+                # This goes by the negotiated encoding, not whether this
+                # body was big enough to compress, so a 304 gets the same
+                # tag as the full response did.
+                etag = etag[:-1] + '-' + self._encoding + '"'
+            headers.append(('ETag', etag))
+        if self.http_last_modified is not None:
+            headers.append(('Last-Modified',
+                            email.utils.formatdate (self.http_last_modified, usegmt=True)))
+        if self._content_encoding is not None:
+            headers.append(('Content-Encoding', self._content_encoding))
+        if self._vary:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if len(self._cookies) > 0:
+            (domain, path) = get_cookie_scope ()
             ck = Cookie.SimpleCookie()
-            ck[cookie] = value
-            nohttp = blinq.config.web_root_url
-            nohttp = nohttp[nohttp.find('://') + 3:]
-            ck[cookie]['domain'] = nohttp[:nohttp.find('/')]
-            ck[cookie]['path'] = nohttp[nohttp.find('/'):]
-            headers.append(('Set-Cookie', ck.output(header='')))
+            for cookie, value, attrs in self._cookies:
+                ck[cookie] = value
+                ck[cookie]['domain'] = domain
+                ck[cookie]['path'] = path
+                for attr, attrval in attrs.items():
+                    ck[cookie][attr.replace ('_', '-')] = attrval
+                headers.append(('Set-Cookie', ck[cookie].output(header='')))
         return (status, headers)
 
-    def output (self, fp=None):
-        self._fp = fp
-        if self._fp is None:
-            self._fp = sys.stdout
+    def output (self, fp=None, header_func=None):
+        """
+        Output the headers and payload to fp, or to stdout
+
+        If header_func is given, it is called with the status and a list
+        of headers instead of writing CGI headers to fp.
+        """
+        if self._timing is None:
+            self._output (fp, header_func)
+        else:
+            self._timing.output (self, fp, header_func)
+
+    def _output (self, fp, header_func):
+        self._start_output (fp, header_func)
+        self._headers_sent = not self.request.http
         if self.request.http:
-            (status, headers) = self.get_response()
-            if self.http_status != 200:
-                self.write('Status: %s \n' % status)
-            for header in headers:
-                self.write('%s: %s\n' % header)
-            self.write('\n')
-        self.output_payload (fp=fp)
+            # Negotiate even without a body, so a 304 or HEAD response
+            # gets the same ETag and Vary as the full response.
+            self._negotiate_encoding ()
+        if (self.request.getenv ('REQUEST_METHOD') == 'HEAD' or
+            self.http_status == 304):
+            # No body follows, so keep the ETag and Vary, but don't start
+            # a compressor or send a Content-Encoding.
+            if not self._headers_sent:
+                self._send_headers (None)
+            if hasattr (self._fp, 'flush'):
+                self._fp.flush ()
+            return
+        if self.payload is not None:
+            self.payload.output (self)
+        if not self._headers_sent:
+            if self._encoding is not None and self._buffer_len >= self.compress_min_size:
+                self._content_encoding = self._encoding
+                body = self._new_compressor ().compress (''.join (self._buffer))
+                body += self._compressor.flush ()
+                self._compressor = None
+                self._buffer = [body]
+                self._buffer_len = len(body)
+            self._send_headers (self._buffer_len)
+            self._flush_buffer ()
+        else:
+            self._flush_buffer ()
+            if self._compressor is not None:
+                self._write_fp (self._compressor.flush ())
+                self._compressor = None
 
     def output_payload (self, fp=None):
-        self._fp = fp
-        if self._fp is None:
-            self._fp = sys.stdout
+        self._start_output (fp, None)
+        self._headers_sent = True
         if self.payload is not None:
             self.payload.output (self)
+        self._flush_buffer ()
+
+    def flush (self):
+        """
+        Send the headers if they have not been sent, then write out any
+        buffered output.  Once this is called, no Content-Length is sent.
+        """
+        self._flush (True)
+        if hasattr (self._fp, 'flush'):
+            self._fp.flush ()
 
     def write (self, txt):
         if isinstance (txt, blinq.reqs.Payload):
@@ -159,7 +380,175 @@ class WebResponse (blinq.reqs.Response):
             return
         if isinstance(txt, unicode):
             txt = txt.encode ('utf-8')
-        self._fp.write (txt)
+        self._buffer.append (txt)
+        self._buffer_len += len(txt)
+        if self._buffer_len >= self._buffer_size:
+            self._flush (False)
+
+    def set_content_length (self, length):
+        """
+        Set the length of the body before any of it is written
+
+        The headers will be sent with this Content-Length, even if the
+        body is too large for the buffer.  This turns off compression,
+        since the compressed length is not known in advance.
+        """
+        self._content_length = length
+        self._encoding = None
+        self._vary = False
+
+    def write_file (self, fd, offset, count, chunk_size=None):
+        """
+        Write count bytes starting at offset from the file descriptor fd
+
+        When os.sendfile is available and the output has a file descriptor
+        of its own, the bytes are copied by the kernel.  Otherwise the file
+        is mapped into memory and written in chunks of chunk_size bytes,
+        which defaults to the buffer size.
+        """
+        if count <= 0:
+            return
+        sendfile = getattr (os, 'sendfile', None)
+        outfd = None
+        if sendfile is not None and self._compressor is None:
+            try:
+                outfd = self._fp.fileno ()
+            except (AttributeError, EnvironmentError, ValueError):
+                outfd = None
+        if outfd is not None:
+            self._flush (False)
+            if hasattr (self._fp, 'flush'):
+                self._fp.flush ()
+            start = time.time ()
+            while count > 0:
+                sent = sendfile (outfd, fd, offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+            if self._timing is not None:
+                self._timing.flush += time.time () - start
+            return
+        chunk_size = chunk_size or self._buffer_size
+        try:
+            data = mmap.mmap (fd, 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            data = None
+        if data is not None:
+            # With a known length or uncompressed output already under way,
+            # the slices can skip the buffer and go straight out.
+            direct = (self._content_length is not None or
+                      (self._headers_sent and self._compressor is None))
+            if direct:
+                self._flush (False)
+            try:
+                end = min (offset + count, len(data))
+                while offset < end:
+                    chunk = data[offset:min (offset + chunk_size, end)]
+                    if direct:
+                        self._write_fp (chunk)
+                    else:
+                        self.write (chunk)
+                    offset += chunk_size
+            finally:
+                data.close ()
+            return
+        os.lseek (fd, offset, os.SEEK_SET)
+        while count > 0:
+            chunk = os.read (fd, min (chunk_size, count))
+            if not chunk:
+                break
+            self.write (chunk)
+            count -= len(chunk)
+
+    def _start_output (self, fp, header_func):
+        self._fp = fp
+        if self._fp is None:
+            self._fp = sys.stdout
+        self._header_func = header_func
+        self._buffer = []
+        self._buffer_len = 0
+        self._encoding = None
+        self._content_encoding = None
+        self._compressor = None
+        self._vary = False
+        self._content_length = None
+
+    def _negotiate_encoding (self):
+        if not self.compress or self.http_status not in (None, 200, 304):
+            return
+        ctype = (self.content_type or '').split (';')[0].strip().lower()
+        if ctype not in self.compress_types:
+            return
+        self._vary = True
+        accepted = []
+        for coding in (self.request.getenv ('HTTP_ACCEPT_ENCODING') or '').split (','):
+            params = coding.split (';')
+            qvalue = 1.0
+            for param in params[1:]:
+                param = param.strip ()
+                if param.startswith ('q='):
+                    try:
+                        qvalue = float (param[2:])
+                    except ValueError:
+                        qvalue = 0.0
+            if qvalue > 0:
+                accepted.append (params[0].strip().lower())
+        for encoding in ('gzip', 'deflate'):
+            if encoding in accepted:
+                self._encoding = encoding
+                return
+
+    def _new_compressor (self):
+        if self._encoding == 'gzip':
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS
+        self._compressor = zlib.compressobj (self.compress_level, zlib.DEFLATED, wbits)
+        return self._compressor
+
+    def _flush (self, sync):
+        if not self._headers_sent:
+            if self._encoding is not None:
+                self._content_encoding = self._encoding
+                self._new_compressor ()
+            self._send_headers (self._content_length)
+        self._flush_buffer (sync)
+
+    def _send_headers (self, content_length):
+        (status, headers) = self.get_response()
+        if content_length is not None:
+            headers.append (('Content-Length', str(content_length)))
+        self._headers_sent = True
+        if self._header_func is not None:
+            self._header_func (status, headers)
+            return
+        lines = []
+        if self.http_status != 200:
+            lines.append ('Status: %s \n' % status)
+        for header in headers:
+            lines.append ('%s: %s\n' % header)
+        lines.append ('\n')
+        self._write_fp (''.join (lines))
+
+    def _flush_buffer (self, sync=False):
+        if len(self._buffer) > 0:
+            data = ''.join (self._buffer)
+            self._buffer = []
+            self._buffer_len = 0
+            if self._compressor is not None:
+                data = self._compressor.compress (data)
+                if sync:
+                    data += self._compressor.flush (zlib.Z_SYNC_FLUSH)
+            self._write_fp (data)
+
+    def _write_fp (self, data):
+        if self._timing is None:
+            self._fp.write (data)
+        else:
+            start = time.time ()
+            self._fp.write (data)
+            self._timing.flush += time.time () - start
 
 
 class TextPayload (blinq.reqs.Payload):
@@ -167,31 +556,314 @@ class TextPayload (blinq.reqs.Payload):
     def __init__ (self, **kw):
         super (TextPayload, self).__init__ (**kw)
         self.content_type = 'text/plain'
-        self._text_content = ''
+        self._text_content = []
 
     def set_content (self, content):
-        self._text_content = content
+        self._text_content = [content]
 
     def add_content (self, content):
-        self._text_content += content
+        self._text_content.append (content)
 
     def output (self, res):
-        res.write (self._text_content)
+        res.write (''.join (self._text_content))
+
+
+class FilePayload (blinq.reqs.Payload):
+    """
+    Payload that streams a file
+
+    The file may be given as a filename, a file object, or a file
+    descriptor.  It is never read into memory all at once; see the
+    write_file method of WebResponse.  The Content-Length and, unless
+    the response sets it, Last-Modified headers come from the file.
+
+    Range requests are supported.  A single range gets a 206 response
+    with a Content-Range header, and several ranges get a 206 response
+    with a multipart/byteranges body.  A Range header with no ranges
+    inside the file gets a 416 response.  A Range header with more than
+    max_ranges ranges is ignored, and the whole file is sent.
+    """
+    max_ranges = 16
+
+    def __init__ (self, file, **kw):
+        content_type = kw.pop ('content_type', 'application/octet-stream')
+        super (FilePayload, self).__init__ (**kw)
+        self.content_type = content_type
+        self._file = file
+
+    def _open (self):
+        if isinstance (self._file, (int, long)):
+            return (self._file, False)
+        elif isinstance (self._file, basestring):
+            return (os.open (self._file, os.O_RDONLY), True)
+        else:
+            if hasattr (self._file, 'flush'):
+                self._file.flush ()
+            return (self._file.fileno (), False)
+
+    def get_ranges (self, res, size, mtime):
+        """
+        Get a list of (first, last) byte ranges requested for the file
+
+        This returns None if the whole file should be sent, and an empty
+        list if no requested range is inside the file.
+        """
+        header = res.request.getenv ('HTTP_RANGE')
+        if header is None or res.http_status not in (None, 200):
+            return None
+        if_range = res.request.getenv ('HTTP_IF_RANGE')
+        if if_range is not None:
+            if if_range.startswith ('"') or if_range.startswith ('W/'):
+                if if_range != res.http_etag:
+                    return None
+            elif if_range != email.utils.formatdate (mtime, usegmt=True):
+                return None
+        unit, sep, spec = header.partition ('=')
+        if unit.strip().lower() != 'bytes' or sep == '':
+            return None
+        specs = spec.split (',')
+        if len(specs) > self.max_ranges:
+            return None
+        ranges = []
+        for spec in specs:
+            first, sep, last = spec.strip().partition ('-')
+            try:
+                if sep == '':
+                    return None
+                elif first == '':
+                    suffix = int (last)
+                    if suffix <= 0:
+                        continue
+                    first = max (0, size - suffix)
+                    last = size - 1
+                else:
+                    first = int (first)
+                    if last == '':
+                        last = size - 1
+                    else:
+                        last = int (last)
+                        if last < first:
+                            return None
+                        last = min (last, size - 1)
+            except ValueError:
+                return None
+            if first < size and first <= last:
+                ranges.append ((first, last))
+        return ranges
+
+    def output (self, res):
+        (fd, close) = self._open ()
+        try:
+            stat = os.fstat (fd)
+            size = stat.st_size
+            if res.http_last_modified is None:
+                res.http_last_modified = stat.st_mtime
+            res.http_accept_ranges = 'bytes'
+            ranges = self.get_ranges (res, size, res.http_last_modified)
+            if ranges is None:
+                res.set_content_length (size)
+                res.write_file (fd, 0, size)
+            elif len(ranges) == 0:
+                res.http_status = 416
+                res.http_content_range = 'bytes */%i' % size
+                res.set_content_length (0)
+            elif len(ranges) == 1:
+                (first, last) = ranges[0]
+                res.http_status = 206
+                res.http_content_range = 'bytes %i-%i/%i' % (first, last, size)
+                res.set_content_length (last - first + 1)
+                res.write_file (fd, first, last - first + 1)
+            else:
+                boundary = os.urandom (16).encode ('hex')
+                heads = []
+                length = 0
+                for (first, last) in ranges:
+                    head = ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %i-%i/%i\r\n\r\n'
+                            % (boundary, self.content_type, first, last, size))
+                    heads.append (head)
+                    length += len(head) + last - first + 1
+                tail = '\r\n--%s--\r\n' % boundary
+                res.http_status = 206
+                res.content_type = 'multipart/byteranges; boundary=' + boundary
+                res.set_content_length (length + len(tail))
+                for i in range (len(ranges)):
+                    (first, last) = ranges[i]
+                    res.write (heads[i])
+                    res.write_file (fd, first, last - first + 1)
+                res.write (tail)
+        finally:
+            if close:
+                os.close (fd)
 
 
 class JsonPayload (blinq.reqs.Payload):
-    """Payload for JSON data"""
+    """
+    Payload for JSON data
+
+    Lists, tuples, and dictionaries are encoded batch_size items at a
+    time with the C-accelerated encoder and written to the response in
+    pieces of about chunk_size bytes.  If set_data is called with
+    immutable=True, the encoded data is cached and reused as long as the
+    same data object is set on a JsonPayload again.
+
+    The encoder can be replaced with set_encoder, which takes a function
+    that is passed the data and returns a string or an iterable of strings.
+    """
+    chunk_size = 8192
+    batch_size = 256
+    cache_size = 128
+    separators = (',', ':')
+    _encoder = None
+    _cache = collections.OrderedDict ()
+    _cache_lock = threading.Lock ()
+
     def __init__ (self, **kw):
         super (JsonPayload, self).__init__(**kw)
         self.content_type = 'application/json'
         self._data = None
+        self._immutable = False
 
-    def set_data (self, data):
+    def set_data (self, data, immutable=False):
         self._data = data
+        self._immutable = immutable
+
+    @staticmethod
+    def set_encoder (encoder):
+        if encoder is not None:
+            encoder = staticmethod (encoder)
+        JsonPayload._encoder = encoder
+        JsonPayload._cache_lock.acquire ()
+        try:
+            JsonPayload._cache.clear ()
+        finally:
+            JsonPayload._cache_lock.release ()
+
+    def _encode (self):
+        if JsonPayload._encoder is not None:
+            return JsonPayload._encoder (self._data)
+        encoder = json.JSONEncoder (separators=self.separators)
+        if isinstance (self._data, (list, tuple, dict)):
+            return self._iterencode (encoder)
+        return encoder.encode (self._data)
+
+    def _iterencode (self, encoder):
+        # JSONEncoder.iterencode never uses the C encoder, so encode batches
+        # of items with encode, which does, and join them here.
+        data = self._data
+        encode = encoder.encode
+        if isinstance (data, dict):
+            items = data.iteritems ()
+            (start, end, batch) = ('{', '}', dict)
+        else:
+            items = iter (data)
+            (start, end, batch) = ('[', ']', list)
+        yield start
+        first = True
+        while True:
+            part = batch (itertools.islice (items, self.batch_size))
+            if len(part) == 0:
+                break
+            if first:
+                first = False
+            else:
+                yield self.separators[0]
+            yield encode (part)[1:-1]
+        yield end
 
     def output (self, res):
-        import json
-        res.write (json.dumps (self._data))
+        if self._immutable:
+            key = id(self._data)
+            JsonPayload._cache_lock.acquire ()
+            try:
+                cached = JsonPayload._cache.get (key)
+            finally:
+                JsonPayload._cache_lock.release ()
+            if cached is None or cached[0] is not self._data:
+                encoded = self._encode ()
+                if not isinstance (encoded, basestring):
+                    encoded = ''.join (encoded)
+                cached = (self._data, encoded)
+            # The cache holds a reference to the data, so its id can't be
+            # reused by another object while it is cached.
+            JsonPayload._cache_lock.acquire ()
+            try:
+                JsonPayload._cache.pop (key, None)
+                JsonPayload._cache[key] = cached
+                while len(JsonPayload._cache) > self.cache_size:
+                    JsonPayload._cache.popitem (last=False)
+            finally:
+                JsonPayload._cache_lock.release ()
+            res.write (cached[1])
+            return
+        encoded = self._encode ()
+        if isinstance (encoded, basestring):
+            res.write (encoded)
+            return
+        chunks = []
+        size = 0
+        for chunk in encoded:
+            chunks.append (chunk)
+            size += len(chunk)
+            if size >= self.chunk_size:
+                res.write (''.join (chunks))
+                chunks = []
+                size = 0
+        if len(chunks) > 0:
+            res.write (''.join (chunks))
+
+
+class SafeHtml (str):
+    """
+    A string of HTML that is already escaped
+
+    HtmlPayload.escape returns instances of this class unchanged, so
+    wrapping markup in SafeHtml keeps it from being escaped twice.
+    Unicode markup is encoded as UTF-8, like the output of escape.
+    """
+    def __new__ (cls, value=''):
+        return str.__new__ (cls, blinq.utils.utf8enc (value))
+
+
+_html_escape_re = re.compile ('[&<>"]')
+_html_escape_table = {ord(u'&'): u'&amp;', ord(u'<'): u'&lt;',
+                      ord(u'>'): u'&gt;', ord(u'"'): u'&quot;'}
+
+def _escape_str (obj):
+    if _html_escape_re.search (obj) is None:
+        return obj
+    return obj.replace ('&', '&amp;').replace ('<', '&lt;').replace (
+        '>', '&gt;').replace ('"', '&quot;')
+
+def _escape_unicode (obj):
+    if _html_escape_re.search (obj) is not None:
+        obj = obj.translate (_html_escape_table)
+    return obj.encode ('utf-8')
+
+def _escape_tuple (obj):
+    return tuple (_escape_list (obj))
+
+def _escape_list (obj):
+    escaped = []
+    for item in obj:
+        func = _html_escapers.get (type (item))
+        if func is not None:
+            escaped.append (func (item))
+        else:
+            escaped.append (HtmlPayload.escape (item))
+    return escaped
+
+def _escape_dict (obj):
+    return _EscapedDict (obj)
+
+_html_escapers = {str: _escape_str, unicode: _escape_unicode,
+                  tuple: _escape_tuple, list: _escape_list,
+                  dict: _escape_dict}
+
+
+class _EscapedDict (dict):
+    """Dictionary that escapes its values as they are looked up"""
+    def __getitem__ (self, key):
+        return HtmlPayload.escape (dict.__getitem__ (self, key))
 
 
 class HtmlPayload (blinq.reqs.Payload):
@@ -202,20 +874,379 @@ class HtmlPayload (blinq.reqs.Payload):
 
     @staticmethod
     def escape (obj):
-        class escdict (dict):
-            def __init__ (self, *args):
-                dict.__init__ (self, *args)
-            def __getitem__ (self, key):
-                return HtmlPayload.escape(dict.__getitem__(self, key))
-        if isinstance (obj, HtmlPayload):
+        """
+        Escape an object for inclusion in HTML
+
+        Strings are escaped, and unicode strings are also encoded as UTF-8.
+        Tuples and lists have each of their items escaped, and dictionaries
+        have their values escaped as they are looked up.  Instances of
+        SafeHtml and HtmlPayload are returned as is, as are any objects
+        other than strings, tuples, lists, and dictionaries.
+        """
+        func = _html_escapers.get (type (obj))
+        if func is not None:
+            return func (obj)
+        if isinstance (obj, (HtmlPayload, SafeHtml, _EscapedDict)):
             return obj
         elif isinstance (obj, unicode):
-            return cgi.escape (obj, True).encode('utf-8')
+            return _escape_unicode (obj)
         elif isinstance (obj, basestring):
-            return cgi.escape (obj, True)
+            return _escape_str (obj)
         elif isinstance (obj, tuple):
-            return tuple (map (HtmlPayload.escape, obj))
+            return _escape_tuple (obj)
+        elif isinstance (obj, list):
+            return _escape_list (obj)
         elif isinstance (obj, dict):
-            return escdict (obj)
+            return _escape_dict (obj)
         else:
             return obj
+
+
+def _convert_int (part):
+    if not part.isdigit ():
+        return None
+    try:
+        return int (part)
+    except ValueError:
+        return None
+
+_route_converters = {
+    'str': lambda part: part,
+    'int': _convert_int
+    }
+
+_route_segment_re = re.compile ('^<(?:(\w+):)?(\w+)>$')
+
+
+class _RouteNode (object):
+    """One path segment in the compiled route trie"""
+    __slots__ = ('static', 'params', 'rest', 'responder', 'pattern')
+
+    def __init__ (self):
+        self.static = {}
+        self.params = []
+        self.rest = None
+        self.responder = None
+        self.pattern = None
+
+    def add_route (self, pattern, responder):
+        node = self
+        parts = [part for part in blinq.utils.utf8dec (pattern).split ('/') if part != '']
+        for i in range (len(parts)):
+            match = _route_segment_re.match (parts[i])
+            if match is None:
+                node = node.static.setdefault (parts[i], _RouteNode ())
+                continue
+            (conv, arg) = match.groups ()
+            conv = conv or 'str'
+            if conv == 'path':
+                if i != len(parts) - 1:
+                    raise ValueError ('Route %s has a path segment before the end.' % pattern)
+                if node.rest is None:
+                    node.rest = (arg, _RouteNode ())
+                elif node.rest[0] != arg:
+                    raise ValueError ('Route %s conflicts with route %s.'
+                                      % (pattern, node.rest[1].pattern))
+                node = node.rest[1]
+                continue
+            if conv not in _route_converters:
+                raise ValueError ('Route %s has an unknown segment type %s.' % (pattern, conv))
+            for param in node.params:
+                if param[0] == conv and param[1] == arg:
+                    node = param[3]
+                    break
+            else:
+                child = _RouteNode ()
+                node.params.append ((conv, arg, _route_converters[conv], child))
+                node = child
+        if node.responder is not None:
+            raise ValueError ('Route %s for %s conflicts with route %s for %s.'
+                              % (pattern, responder.__name__,
+                                 node.pattern, node.responder.__name__))
+        node.responder = responder
+        node.pattern = pattern
+
+    def match (self, path, i, args):
+        if i == len(path):
+            if self.responder is not None:
+                return self
+            return None
+        child = self.static.get (path[i])
+        if child is not None:
+            found = child.match (path, i + 1, args)
+            if found is not None:
+                return found
+        for (conv, arg, convert, child) in self.params:
+            value = convert (path[i])
+            if value is None:
+                continue
+            found = child.match (path, i + 1, args)
+            if found is not None:
+                args[arg] = value
+                return found
+        if self.rest is not None and self.rest[1].responder is not None:
+            args[self.rest[0]] = u'/'.join (path[i:])
+            return self.rest[1]
+        return None
+
+    def get_routes (self, routes):
+        if self.responder is not None:
+            routes.append ((self.pattern, self.responder))
+        for key in sorted (self.static):
+            self.static[key].get_routes (routes)
+        for param in self.params:
+            param[3].get_routes (routes)
+        if self.rest is not None:
+            self.rest[1].get_routes (routes)
+
+
+class WebResponder (blinq.reqs.Responder):
+    """
+    Extension point for responders to web paths
+
+    Each responder lists the paths it handles in routes, as patterns like
+    /project/<name>/<int:id>/<path:file>.  A segment in angle brackets
+    matches any segment, or only an integer for int, and a path segment
+    at the end matches all remaining segments.  Matched segments are put
+    in a dictionary stored as the route_args data of the request.
+
+    The routes of all extensions are compiled once into a trie, which is
+    rebuilt only when the list of extensions changes.  Call respond on
+    WebResponder itself to dispatch a request to the responder for its
+    path.  Paths with no responder get a 404 response.  When timing is
+    enabled, blinq.reqs.timing.respond calls dispatch first, so requests
+    are timed under the name of the responder they are dispatched to.
+    """
+    routes = ()
+
+    _route_trie = None
+    _route_generation = None
+
+    @classmethod
+    def get_route_trie (cls):
+        """Get the compiled route trie, rebuilding it if extensions changed"""
+        if (WebResponder._route_trie is not None and
+            WebResponder._route_generation == blinq.ext.get_generation ()):
+            return WebResponder._route_trie
+        extensions = WebResponder.get_extensions ()
+        trie = _RouteNode ()
+        for responder in extensions:
+            for pattern in responder.routes:
+                trie.add_route (pattern, responder)
+        WebResponder._route_trie = trie
+        WebResponder._route_generation = blinq.ext.get_generation ()
+        return trie
+
+    @classmethod
+    def resolve (cls, path):
+        """
+        Find the responder for a path, given as a list of segments
+
+        This returns a tuple of the responder and a dictionary of the
+        matched segments, or (None, None) if no route matches.
+        """
+        args = {}
+        node = cls.get_route_trie().match (path, 0, args)
+        if node is None:
+            return (None, None)
+        return (node.responder, args)
+
+    @classmethod
+    def get_routes (cls):
+        """Get a list of (pattern, responder) tuples for all routes"""
+        routes = []
+        cls.get_route_trie().get_routes (routes)
+        return routes
+
+    @classmethod
+    def format_routes (cls):
+        """Format the route table for debugging"""
+        routes = cls.get_routes ()
+        width = max ([len(pattern) for (pattern, responder) in routes] or [0])
+        lines = []
+        for (pattern, responder) in routes:
+            lines.append ('%s  %s.%s' % (pattern.ljust (width),
+                                         responder.__module__, responder.__name__))
+        return '\n'.join (lines)
+
+    @classmethod
+    def dispatch (cls, request):
+        """
+        Get the responder for a request, storing its route_args data
+
+        Paths with no route get a responder that returns a 404 response.
+        Subclasses are their own responders.
+        """
+        if cls is not WebResponder:
+            return cls
+        start = blinq.reqs.timing.start ()
+        parse = request._parse_time
+        (responder, args) = cls.resolve (request.path)
+        if responder is None:
+            responder = _NotFoundResponder
+        else:
+            request.set_data ('route_args', args)
+        if start is not None:
+            # Parsing the path is timed as parse, not as dispatch
+            blinq.reqs.timing.record (blinq.reqs.timing.get_name (responder), 'dispatch',
+                                      blinq.reqs.timing.elapsed (start) -
+                                      (request._parse_time - parse))
+        return responder
+
+    @classmethod
+    def respond (cls, request):
+        if cls is not WebResponder:
+            raise NotImplementedError ('%s does not provide the respond method.'
+                                       % cls.__name__)
+        return cls.dispatch (request).respond (request)
+
+
+class _NotFoundResponder (object):
+    """Responder used by WebResponder for paths with no route"""
+    @classmethod
+    def respond (cls, request):
+        return get_error_response (request, 404, 'Not found')
+
+
+def get_error_response (request, http_status, desc):
+    """Get a plain text response with an error status, as for a FormError"""
+    response = WebResponse (request)
+    response.http_status = http_status
+    payload = TextPayload ()
+    payload.set_content (desc)
+    response.payload = payload
+    return response
+
+
+class WebApplication (object):
+    """
+    WSGI application object for web responders
+
+    A WebApplication wraps a responder, which is any object with a respond
+    method taking a WebRequest and returning a WebResponse.  Unlike the CGI
+    path, the interpreter and any imported extensions persist across
+    requests, so they are only loaded once per process.
+
+    The body is returned to the server as an iterable.  Most responses are
+    output at once and returned as a list, which holds just the body when
+    it fits in the response buffer.  Payloads that stream, which are the
+    ones in streamed_payloads, are output on a thread of their own, and
+    their chunks are yielded by a generator as they are flushed.
+
+    A FormError raised while responding gets a response with its status,
+    as long as the headers have not been sent yet.
+    """
+    streamed_payloads = (blinq.reqs.StreamPayload, FilePayload)
+
+    def __init__ (self, responder, **kw):
+        super (WebApplication, self).__init__ (**kw)
+        self.responder = responder
+
+    def __call__ (self, environ, start_response):
+        request = WebRequest (environ=environ,
+                              stdin=environ.get ('wsgi.input'))
+        try:
+            response = blinq.reqs.timing.respond (self.responder, request)
+        except blinq.reqs.form.FormError, err:
+            response = get_error_response (request, err.http_status, err.desc)
+        if isinstance (response.payload, self.streamed_payloads):
+            return _iter_streamed (response, start_response)
+        try:
+            writer = _output_buffered (response)
+        except blinq.reqs.form.FormError, err:
+            # Nothing has gone to the server yet, even if the response
+            # flushed early, so the error can still replace it.
+            writer = _output_buffered (
+                get_error_response (request, err.http_status, err.desc))
+        start_response (writer.status, writer.headers)
+        return writer.chunks
+
+
+class _WsgiWriter (object):
+    """
+    Output file for WebApplication
+
+    The status and headers are kept for start_response, and written data
+    is collected in chunks, which is returned to the server as the body.
+    If queue is given, everything is put on it instead, for a generator
+    on another thread to pass on to the server.
+    """
+    def __init__ (self, queue=None):
+        self.status = None
+        self.headers = None
+        self.chunks = []
+        self.closed = False
+        self._queue = queue
+
+    def start (self, status, headers):
+        self.status = status
+        self.headers = [(key, str(val).strip()) for key, val in headers
+                        if val is not None]
+        if self._queue is not None:
+            self._queue.put (('start', (self.status, self.headers)))
+
+    def write (self, txt):
+        if self._queue is None:
+            self.chunks.append (txt)
+            return
+        if self.closed:
+            raise IOError ('The client stopped reading the response.')
+        self._queue.put (txt)
+
+
+def _output_buffered (response):
+    """Output a response to a new _WsgiWriter and return the writer"""
+    writer = _WsgiWriter ()
+    response.output (fp=writer, header_func=writer.start)
+    return writer
+
+def _iter_streamed (response, start_response):
+    """
+    Output a response on a thread, yielding its body as it is flushed
+
+    The queue between the thread and the generator is short, so the thread
+    waits for the server to send each chunk rather than reading ahead.
+    """
+    queue = Queue.Queue (4)
+    writer = _WsgiWriter (queue)
+    def run ():
+        try:
+            response.output (fp=writer, header_func=writer.start)
+            queue.put (('end', None))
+        except:
+            queue.put (('error', sys.exc_info ()))
+    thread = threading.Thread (target=run)
+    thread.daemon = True
+    thread.start ()
+    try:
+        while True:
+            item = queue.get ()
+            if isinstance (item, str):
+                yield item
+                continue
+            (kind, value) = item
+            if kind == 'start':
+                start_response (value[0], value[1])
+            elif kind == 'end':
+                return
+            elif (writer.status is None and
+                  isinstance (value[1], blinq.reqs.form.FormError)):
+                errwriter = _output_buffered (
+                    get_error_response (response.request,
+                                        value[1].http_status, value[1].desc))
+                start_response (errwriter.status, errwriter.headers)
+                for chunk in errwriter.chunks:
+                    yield chunk
+                return
+            else:
+                raise value[0], value[1], value[2]
+    finally:
+        # If the server stops iterating early, make the thread's next write
+        # fail.  Emptying the queue lets a write already waiting finish, and
+        # leaves room for the thread's last item.
+        writer.closed = True
+        try:
+            while True:
+                queue.get_nowait ()
+        except Queue.Empty:
+            pass
@@ -19,13 +19,18 @@
 """Various utility functions"""
 
 import codecs
+import heapq
+import os
+
+_utf8_decode = codecs.getdecoder ('utf-8')
+_utf8_encode = codecs.getencoder ('utf-8')
 
 def utf8dec (s):
     """
     Decode a string to UTF-8, or don't if it already is
     """
     if isinstance(s, str):
-        return codecs.getdecoder('utf-8')(s, 'replace')[0]
+        return _utf8_decode(s, 'replace')[0]
     else:
         return s
 
@@ -34,10 +39,149 @@ def utf8enc (s):
     Encode a unicode object to UTF-8, or don't if it already is
     """
     if isinstance(s, unicode):
-        return codecs.getencoder('utf-8')(s)[0]
+        return _utf8_encode(s)[0]
     else:
         return s
 
+def utf8dec_list (lst):
+    """
+    Decode each string in a list from UTF-8, returning a new list
+    """
+    decode = _utf8_decode
+    return [decode (s, 'replace')[0] if isinstance (s, str) else s
+            for s in lst]
+
+def utf8dec_dict (dct, keys=False):
+    """
+    Decode each string value in a dictionary from UTF-8, returning a new
+    dictionary.  If keys is True, the keys are decoded as well.
+    """
+    decode = _utf8_decode
+    ret = {}
+    for key, val in dct.iteritems ():
+        if keys and isinstance (key, str):
+            key = decode (key, 'replace')[0]
+        if isinstance (val, str):
+            val = decode (val, 'replace')[0]
+        ret[key] = val
+    return ret
+
+
+class UTF8Decoder (object):
+    """
+    Incremental UTF-8 decoder for text that arrives in chunks
+
+    A multibyte sequence split across two chunks is held back until the
+    rest of it arrives, rather than being replaced as invalid.  Call
+    decode with final=True after the last chunk to flush anything left.
+    """
+    __slots__ = ('_decoder',)
+
+    def __init__ (self):
+        self._decoder = codecs.getincrementaldecoder ('utf-8') ('replace')
+
+    def decode (self, s, final=False):
+        return self._decoder.decode (s, final)
+
+    def reset (self):
+        self._decoder.reset ()
+
+
+class SqliteConnection (object):
+    """
+    SQLite connection that is opened on first use
+
+    Connections can't be shared with forked children, so get makes a new
+    one whenever the process changes.  The SQL statements in schema are
+    run on each new connection, so they should use IF NOT EXISTS.
+    """
+    def __init__ (self, filename, schema=(), **kw):
+        super (SqliteConnection, self).__init__ (**kw)
+        self.filename = filename
+        self.schema = schema
+        self._conn = None
+        self._pid = None
+
+    def get (self):
+        """Get the connection for this process, connecting if needed"""
+        if self._conn is None or self._pid != os.getpid ():
+            import sqlite3
+            conn = sqlite3.connect (self.filename, check_same_thread=False)
+            for statement in self.schema:
+                conn.execute (statement)
+            conn.commit ()
+            self._conn = conn
+            self._pid = os.getpid ()
+        return self._conn
+
+def _attrget (obj, attr):
+    """Get an attribute or list of attributes from an object"""
+    if isinstance (attr, tuple) or isinstance (attr, list):
+        if len(attr) > 1:
+            return _attrget (_attrget (obj, attr[0]), attr[1:])
+        else:
+            return _attrget (obj, attr[0])
+    elif isinstance (obj, dict):
+        return obj.get (attr)
+    elif isinstance (attr, basestring):
+        if attr.startswith('[') and attr.endswith(']'):
+            return obj[attr[1:-1]]
+        return getattr (obj, attr)
+    elif isinstance (attr, int):
+        return obj.__getitem__ (attr)
+    elif isinstance (obj, basestring):
+        return obj.lower()
+    else:
+        return obj
+
+def _attrkeys (attrs):
+    """Split sort attributes into (attr, reverse) pairs"""
+    keys = []
+    for attr in attrs:
+        try:
+            attrf = attr[0]
+        except:
+            attrf = None
+        if attrf == '-':
+            keys.append ((attr[1:], True))
+        else:
+            keys.append ((attr, False))
+    return keys
+
+def _attrkey (obj, attr):
+    """Get a sort key for an attribute, with None first and strings lowercased"""
+    val = _attrget (obj, attr)
+    if val is None:
+        return (0,)
+    elif isinstance (val, unicode):
+        return (1, val.lower())
+    elif isinstance (val, basestring):
+        return (1, utf8dec(val).lower())
+    else:
+        return (1, val)
+
+class _SortKey (object):
+    """Composite sort key that honors a reverse flag for each component"""
+    __slots__ = ('keys', 'reverse')
+
+    def __init__ (self, keys, reverse):
+        self.keys = keys
+        self.reverse = reverse
+
+    def __lt__ (self, other):
+        for key1, key2, reverse in zip (self.keys, other.keys, self.reverse):
+            if key1 != key2:
+                if reverse:
+                    return key2 < key1
+                return key1 < key2
+        return False
+
+    def __eq__ (self, other):
+        return self.keys == other.keys
+
+    def __ne__ (self, other):
+        return self.keys != other.keys
+
 def attrsorted (lst, *attrs):
     """
     Sort a list of objects based on given object attributes
@@ -53,63 +197,45 @@ def attrsorted (lst, *attrs):
 
     All string comparisons are case-insensitive.
     """
-    def attrget (obj, attr):
-        """Get an attribute or list of attributes from an object"""
-        if isinstance (attr, tuple) or isinstance (attr, list):
-            if len(attr) > 1:
-                return attrget (attrget (obj, attr[0]), attr[1:])
-            else:
-                return attrget (obj, attr[0])
-        elif isinstance (obj, dict):
-            return obj.get (attr)
-        elif isinstance (attr, basestring):
-            if attr.startswith('[') and attr.endswith(']'):
-                return obj[attr[1:-1]]
-            return getattr (obj, attr)
-        elif isinstance (attr, int):
-            return obj.__getitem__ (attr)
-        elif isinstance (obj, basestring):
-            return obj.lower()
-        else:
-            return obj
-
-    def lcmp (val1, val2):
-        """Compare two objects, case-insensitive if strings"""
-        if val1 is None:
-            if val2 is None:
-                return 0
-            return -1
-        elif val2 is None:
-            return 1
-        elif isinstance (val1, unicode):
-            v1 = val1.lower()
-        elif isinstance (val1, basestring):
-            v1 = val1.decode('utf-8').lower()
-        else:
-            v1 = val1
-        if isinstance (val2, unicode):
-            v2 = val2.lower()
-        elif isinstance (val1, basestring):
-            v2 = val2.decode('utf-8').lower()
-        else:
-            v2 = val2
-        return cmp (v1, v2)
+    keys = _attrkeys (attrs)
+    decorated = [([_attrkey (obj, attr) for attr, reverse in keys], obj)
+                 for obj in lst]
+    if True not in [reverse for attr, reverse in keys]:
+        decorated.sort (key=lambda dec: dec[0])
+    else:
+        # Sort stably on each key from last to first, so that each key only
+        # reorders objects whose earlier keys are equal.
+        for i in range (len(keys) - 1, -1, -1):
+            decorated.sort (key=lambda dec: dec[0][i], reverse=keys[i][1])
+    return [dec[1] for dec in decorated]
 
-    def attrcmp (val1, val2, attrs):
-        """Compare two objects based on some attributes"""
-        attr = attrs[0]
-        try:
-            attrf = attr[0]
-        except:
-            attrf = None
-        if attrf == '-':
-            attr = attr[1:]
-            cmpval = lcmp (attrget(val2, attr), attrget(val1, attr))
-        else:
-            cmpval = lcmp (attrget(val1, attr), attrget(val2, attr))
-        if cmpval == 0 and len(attrs) > 1:
-            return attrcmp (val1, val2, attrs[1:])
-        else:
-            return cmpval
+def attrsorted_topk (lst, k, *attrs):
+    """
+    Get the first k objects that attrsorted would return
+
+    This uses a heap, so it does not sort the whole list.
+    """
+    if k <= 0:
+        return []
+    keys = _attrkeys (attrs)
+    reverse = [rev for attr, rev in keys]
+    def plainkey (obj):
+        return [_attrkey (obj, attr) for attr, rev in keys]
+    if True not in reverse:
+        return heapq.nsmallest (k, lst, key=plainkey)
+    if False not in reverse:
+        # Like sorted with reverse=True, nlargest keeps ties in list order
+        return heapq.nlargest (k, lst, key=plainkey)
+    def sortkey (obj):
+        return _SortKey (plainkey (obj), reverse)
+    return heapq.nsmallest (k, lst, key=sortkey)
 
-    return sorted (lst, lambda val1, val2: attrcmp (val1, val2, attrs))
+def attrsorted_page (lst, page, per_page, *attrs):
+    """
+    Get one page of the objects that attrsorted would return
+
+    Pages are numbered from 1, and each page has per_page objects.
+    """
+    if page < 1:
+        return []
+    return attrsorted_topk (lst, page * per_page, *attrs)[(page - 1) * per_page:]